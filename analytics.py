@@ -0,0 +1,298 @@
+import json
+import threading
+from array import array
+from datetime import date
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無ければ array と素の Python で集計する（遅いが結果は同じ）
+    np = None
+
+INCOME = '収入'
+EXPENSE = '支出'
+PERIODS = ('day', 'week', 'month', 'quarter', 'year')
+GROUP_KEYS = ('category', 'subcategory')
+# 列の型（array の typecode と NumPy の dtype）
+COLUMN_TYPES = {'days': ('i', 'int32'), 'months': ('i', 'int32'), 'categories': ('i', 'int32'),
+                'subcategories': ('i', 'int32'), 'amounts': ('q', 'int64')}
+# 日付の通し番号（date.toordinal()）と年×12+月-1 は SQL 側で計算する。日付として読めない行は対象外
+SNAPSHOT_COLUMNS = """
+    strftime('%Y-%m', date),
+    CAST(julianday(date) - 1721424.5 AS INTEGER),
+    CAST(strftime('%Y', date) AS INTEGER) * 12 + CAST(strftime('%m', date) AS INTEGER) - 1,
+    COALESCE(category, ''), COALESCE(subcategory, ''), CAST(COALESCE(amount, 0) AS INTEGER)
+"""
+
+def _column(name, values):
+    typecode, dtype = COLUMN_TYPES[name]
+    if np is not None:
+        return np.array(values, dtype=dtype)
+    return array(typecode, values)
+
+def _concat(name, parts):
+    typecode, dtype = COLUMN_TYPES[name]
+    if np is not None:
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+    result = array(typecode)
+    for part in parts:
+        result.extend(part)
+    return result
+
+class Snapshot:
+    # records とアーカイブの列指向コピー。月ごとのセグメントで持ち、データ版数が進んだら変わった月だけ読み直す
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data_version = None
+        self.labels = ['']  # 区分・サブカテゴリの文字列（コード → 文字列）。'' は 0 番
+        self._codes = {'': 0}
+        self._segments = {}
+        self.columns = {name: _concat(name, []) for name in COLUMN_TYPES}
+        self.monthly = (None, None)  # (元にした columns, 月×区分の合計)。移動平均・見通しで使い回す
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.labels)
+            self.labels.append(value)
+        return code
+
+    def refresh(self, c, data_version):
+        # c は版数を読んだのと同じ読み取りトランザクションのカーソル。更新したら True
+        if self.data_version == data_version:
+            return False
+        if self.data_version is None:
+            months = None
+        else:
+            c.execute("SELECT month FROM record_changes WHERE data_version >= ?", (self.data_version,))
+            months = [row[0] for row in c.fetchall()]
+        self._load(c, months)
+        self.data_version = data_version
+        return True
+
+    def _load(self, c, months):
+        if months is None:
+            c.execute(f"""
+                SELECT {SNAPSHOT_COLUMNS} FROM records WHERE julianday(date) IS NOT NULL
+                UNION ALL
+                SELECT {SNAPSHOT_COLUMNS} FROM records_archive WHERE julianday(date) IS NOT NULL
+            """)
+            self._segments = {}
+        else:
+            if not months:
+                return
+            month_list = json.dumps([m for m in months if m])
+            c.execute(f"""
+                SELECT {SNAPSHOT_COLUMNS} FROM records
+                WHERE month IN (SELECT value FROM json_each(?)) AND julianday(date) IS NOT NULL
+                UNION ALL
+                SELECT {SNAPSHOT_COLUMNS} FROM records_archive a
+                JOIN json_each(?) m ON a.date BETWEEN m.value || '-00' AND m.value || '-99'
+                WHERE julianday(a.date) IS NOT NULL
+            """, (month_list, month_list))
+            for month in months:
+                self._segments.pop(month, None)
+        rows = {}
+        code = self.code
+        for month, day, month_index, category, subcategory, amount in c:
+            segment = rows.get(month)
+            if segment is None:
+                segment = rows[month] = ([], [], [], [], [])
+            segment[0].append(day)
+            segment[1].append(month_index)
+            segment[2].append(code(category))
+            segment[3].append(code(subcategory))
+            segment[4].append(amount)
+        for month, values in rows.items():
+            self._segments[month] = {name: _column(name, column) for name, column in zip(COLUMN_TYPES, values)}
+        # 読み手は self.columns をまとめて差し替えた後の値だけを見る
+        ordered = [self._segments[m] for m in sorted(self._segments)]
+        self.columns = {name: _concat(name, [s[name] for s in ordered]) for name in COLUMN_TYPES}
+
+    def __len__(self):
+        return len(self.columns['amounts'])
+
+def period_keys(columns, period):
+    # 期間ごとの整数キー（week は月曜始まり）
+    days, months = columns['days'], columns['months']
+    if np is not None:
+        return {
+            'day': lambda: days,
+            'week': lambda: (days - 1) // 7,
+            'month': lambda: months,
+            'quarter': lambda: months // 3,
+            'year': lambda: months // 12,
+        }[period]()
+    return {
+        'day': lambda: days,
+        'week': lambda: [(d - 1) // 7 for d in days],
+        'month': lambda: months,
+        'quarter': lambda: [m // 3 for m in months],
+        'year': lambda: [m // 12 for m in months],
+    }[period]()
+
+def period_label(period, key):
+    if period == 'day':
+        return date.fromordinal(key).isoformat()
+    if period == 'week':
+        return date.fromordinal(key * 7 + 1).isoformat()
+    if period == 'month':
+        return f"{key // 12:04d}-{key % 12 + 1:02d}"
+    if period == 'quarter':
+        return f"{key // 4:04d}-Q{key % 4 + 1}"
+    return str(key)
+
+def pivot(snapshot, period='month', by=('category',), start=None, end=None, category=None):
+    # 期間 × by（区分・サブカテゴリ）ごとの件数と合計。start/end は date（両端を含む）
+    columns = snapshot.columns
+    labels = snapshot.labels
+    category_code = snapshot._codes.get(category) if category else None
+    if category and category_code is None:
+        return []
+    keys = period_keys(columns, period)
+    use_category = 'category' in by
+    use_subcategory = 'subcategory' in by
+    # グループのキーは (期間, 区分, サブカテゴリ) を1つの整数にまとめたもの
+    category_width = len(labels) if use_category else 1
+    subcategory_width = len(labels) if use_subcategory else 1
+    if np is not None:
+        categories, subcategories, amounts = columns['categories'], columns['subcategories'], columns['amounts']
+        # 絞り込みがあるときだけ行を選ぶ（選ぶと列のコピーが要る）
+        if start is not None or end is not None or category_code is not None:
+            mask = np.ones(len(keys), dtype=bool)
+            if start is not None:
+                mask &= columns['days'] >= start.toordinal()
+            if end is not None:
+                mask &= columns['days'] <= end.toordinal()
+            if category_code is not None:
+                mask &= categories == category_code
+            keys, categories, subcategories, amounts = keys[mask], categories[mask], subcategories[mask], amounts[mask]
+        if len(keys) == 0:
+            return []
+        base = int(keys.min())
+        group = (keys - base).astype(np.int64)
+        if use_category:
+            group = group * category_width + categories
+        if use_subcategory:
+            group = group * subcategory_width + subcategories
+        # キーの範囲が狭ければ bincount、広ければ sort で集計する
+        if int(group.max()) < 4 * len(group) + 1024:
+            counts = np.bincount(group)
+            totals = np.bincount(group, weights=amounts)
+            present = np.flatnonzero(counts)
+            grouped = zip(present.tolist(), counts[present].tolist(), totals[present].round().astype(np.int64).tolist())
+        else:
+            present, inverse, counts = np.unique(group, return_inverse=True, return_counts=True)
+            totals = np.zeros(len(present), dtype=np.int64)
+            np.add.at(totals, inverse, amounts)
+            grouped = zip(present.tolist(), counts.tolist(), totals.tolist())
+    else:
+        base = 0
+        start_day = start.toordinal() if start is not None else None
+        end_day = end.toordinal() if end is not None else None
+        sums = {}
+        for key, day, cat, sub, amount in zip(keys, columns['days'], columns['categories'],
+                                              columns['subcategories'], columns['amounts']):
+            if (start_day is not None and day < start_day) or (end_day is not None and day > end_day):
+                continue
+            if category_code is not None and cat != category_code:
+                continue
+            group = ((key * category_width + (cat if use_category else 0)) * subcategory_width
+                     + (sub if use_subcategory else 0))
+            entry = sums.get(group)
+            if entry is None:
+                sums[group] = [1, amount]
+            else:
+                entry[0] += 1
+                entry[1] += amount
+        grouped = ((group, count, total) for group, (count, total) in sums.items())
+
+    rows = []
+    for group, count, total in grouped:
+        rest, sub = divmod(group, subcategory_width)
+        key, cat = divmod(rest, category_width)
+        row = {'period': period_label(period, key + base)}
+        if use_category:
+            row['category'] = labels[cat]
+        if use_subcategory:
+            row['subcategory'] = labels[sub]
+        row['count'] = count
+        row['total'] = int(total)
+        rows.append(row)
+    rows.sort(key=lambda r: (r['period'], r.get('category', ''), r.get('subcategory', '')))
+    return rows
+
+def shift_month(month, n):
+    year, m = map(int, month.split('-'))
+    index = year * 12 + m - 1 + n
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def monthly_totals(snapshot):
+    columns = snapshot.columns
+    cached_columns, totals = snapshot.monthly
+    if cached_columns is not columns:
+        totals = {(row['period'], row['category']): row['total'] for row in pivot(snapshot, 'month', ('category',))}
+        snapshot.monthly = (columns, totals)
+    return totals
+
+def monthly_series(totals, first=None, last=None):
+    # 区分ごとの月次合計を、記録のない月を 0 で埋めた連続の系列にする
+    months = sorted({month for month, _ in totals})
+    first = first or (months[0] if months else None)
+    last = last or (months[-1] if months else None)
+    periods = []
+    if first and last:
+        month = first
+        while month <= last:
+            periods.append(month)
+            month = shift_month(month, 1)
+    return periods, {
+        category: [totals.get((month, category), 0) for month in periods]
+        for category in (INCOME, EXPENSE)
+    }
+
+def moving_average(values, window):
+    # 直近 window 個の平均（値が揃うまでは None）
+    result = []
+    running = 0
+    for i, value in enumerate(values):
+        running += value
+        if i >= window:
+            running -= values[i - window]
+        result.append(round(running / window) if i >= window - 1 else None)
+    return result
+
+def rolling(snapshot, window=3):
+    periods, series = monthly_series(monthly_totals(snapshot))
+    net = [i - e for i, e in zip(series[INCOME], series[EXPENSE])]
+    return {
+        'window': window,
+        'periods': periods,
+        'income': series[INCOME],
+        'expense': series[EXPENSE],
+        'income_average': moving_average(series[INCOME], window),
+        'expense_average': moving_average(series[EXPENSE], window),
+        'net_average': moving_average(net, window),
+    }
+
+def forecast(snapshot, initial_fee, months=6, window=3, today=None):
+    # 直近 window か月（今月を除く、締まった月）の平均収支が続くとして、来月以降の残高を見積もる
+    # 今月の実績は現在の残高に含まれているので、見込みは来月から
+    today = today or date.today()
+    this_month = today.strftime('%Y-%m')
+    last_complete = shift_month(this_month, -1)
+    totals = monthly_totals(snapshot)
+    periods, series = monthly_series(totals, first=shift_month(last_complete, -(window - 1)), last=last_complete)
+    income = round(sum(series[INCOME]) / window)
+    expense = round(sum(series[EXPENSE]) / window)
+    balance = ((initial_fee or 0) + sum(t for (_, category), t in totals.items() if category == INCOME)
+               - sum(t for (_, category), t in totals.items() if category == EXPENSE))
+    rows = []
+    projected = balance
+    for n in range(1, months + 1):
+        projected += income - expense
+        rows.append({'month': shift_month(this_month, n), 'income': income, 'expense': expense, 'balance': projected})
+    return {
+        'basis': {'from': periods[0], 'to': periods[-1], 'income': income, 'expense': expense},
+        'balance': balance,
+        'months': rows,
+    }
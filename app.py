@@ -1,14 +1,233 @@
-from flask import Flask, render_template, request, redirect, jsonify, Response
+from flask import Flask, render_template, request, redirect, jsonify, Response, g, make_response, stream_with_context, url_for, abort, has_app_context
 import sqlite3
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import csv
+import functools
+import hmac
 import io
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+import click
+from markupsafe import escape
+
+import analytics
+import assets
+import budget_variance
+import instrumentation
+import precompute
+from write_queue import WriteQueue
 
 app = Flask(__name__)
 DB_NAME = 'account.db'
+# SQLite の接続設定（WAL で読み取りが書き込みを待たないようにする）
+app.config.update(
+    SQLITE_JOURNAL_MODE='WAL',
+    SQLITE_SYNCHRONOUS='NORMAL',
+    SQLITE_CACHE_SIZE=-16000,  # 負数は KiB 単位
+    SQLITE_MMAP_SIZE=64 * 1024 * 1024,
+    SQLITE_BUSY_TIMEOUT=5000,  # ミリ秒
+    SQLITE_STATEMENT_CACHE=256,
+    # 計測（リクエスト・SQL・テンプレートの時間、遅いSQLのログ、/metrics）。環境変数で有効にする
+    INSTRUMENTATION=os.environ.get('ACCOUNT_INSTRUMENTATION') == '1',
+    SLOW_QUERY_MS=float(os.environ.get('ACCOUNT_SLOW_QUERY_MS', 100)),
+    # 書き込みを専用スレッドに集めてまとめてコミットする（同時投稿が多いとき向け）
+    WRITE_QUEUE=os.environ.get('ACCOUNT_WRITE_QUEUE') == '1',
+    WRITE_QUEUE_WINDOW_MS=5,
+    WRITE_QUEUE_MAX_BATCH=100,
+    WRITE_QUEUE_IDLE_TIMEOUT=60,  # この秒数書き込みの無いDBファイルのライタースレッドと接続は閉じる
+    # 条件付きリクエスト対応ルートの Cache-Control（no-cache は毎回 ETag で再検証させる）
+    CACHE_CONTROL={
+        'api': 'private, no-cache',
+        'reports': 'private, no-cache',
+        'export': 'private, no-cache',
+    },
+    # 団体ごとにDBファイルを分ける。None: 単一DB（DB_NAME）、'prefix': /t/<団体>/...、'subdomain': <団体>.TENANT_DOMAIN
+    TENANT_MODE=os.environ.get('ACCOUNT_TENANT_MODE') or None,
+    TENANT_DOMAIN=os.environ.get('ACCOUNT_TENANT_DOMAIN', ''),
+    TENANTS_DIR=os.environ.get('ACCOUNT_TENANTS_DIR', 'tenants'),
+    TENANT_POOL_SIZE=32,  # プロセス全体で開いておく読み書き用接続の上限（貸し出し中を含む。超えるときは最も古い空き接続を閉じる）
+    TENANT_REPORT_WORKERS=8,
+    # 全団体の集計レポート（/admin/tenants）の認証トークン。未設定なら無効
+    ADMIN_TOKEN=os.environ.get('ACCOUNT_ADMIN_TOKEN'),
+    # 起動時に static/ の CSS/JS をハッシュ付きの名前でビルドする（無効なら flask build-assets の出力を使う）
+    ASSETS_BUILD_ON_STARTUP=os.environ.get('ACCOUNT_ASSETS_BUILD', '1') == '1',
+    # /reports・/budget の集計を書き込み後に裏で作り直す。古い集計は MAX_STALENESS 秒まで返す
+    PRECOMPUTE=os.environ.get('ACCOUNT_PRECOMPUTE', '1') == '1',
+    PRECOMPUTE_DEBOUNCE_MS=500,
+    PRECOMPUTE_MAX_STALENESS=30,
+    PRECOMPUTE_MAX_ENTRIES=256,
+)
+instrumentation.init_app(app)
+assets.init_app(app)
+
+# 団体名（URL・サブドメイン・ファイル名に使う）
+TENANT_PATTERN = re.compile(r'[a-z0-9][a-z0-9_-]{0,62}')
+# 団体を特定しなくてよいエンドポイント
+TENANTLESS_ENDPOINTS = {'admin_tenants', 'assets', 'metrics', 'static'}
+
+class TenantPrefixMiddleware:
+    # prefix モードで /t/<団体>/... の /t/<団体> を SCRIPT_NAME に移す（url_for やリンクにも付くようになる）
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if app.config['TENANT_MODE'] == 'prefix':
+            parts = environ.get('PATH_INFO', '').split('/', 3)
+            if len(parts) >= 3 and parts[1] == 't' and TENANT_PATTERN.fullmatch(parts[2]):
+                environ['account.tenant'] = parts[2]
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + f'/t/{parts[2]}'
+                environ['PATH_INFO'] = '/' + (parts[3] if len(parts) > 3 else '')
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = TenantPrefixMiddleware(app.wsgi_app)
+
+def tenant_db_path(tenant):
+    return os.path.join(app.config['TENANTS_DIR'], f'{tenant}.db')
+
+def request_tenant():
+    mode = app.config['TENANT_MODE']
+    if mode == 'prefix':
+        return request.environ.get('account.tenant')
+    if mode == 'subdomain':
+        host = request.host.split(':')[0].lower()
+        suffix = '.' + app.config['TENANT_DOMAIN'].lower()
+        if host.endswith(suffix) and TENANT_PATTERN.fullmatch(host[:-len(suffix)]):
+            return host[:-len(suffix)]
+    return None
+
+@app.before_request
+def resolve_tenant():
+    # 団体モードでは、存在する団体のDBだけを使う（知らない名前でファイルを作らない）
+    if not app.config['TENANT_MODE'] or request.endpoint in TENANTLESS_ENDPOINTS:
+        return
+    tenant = request_tenant()
+    if tenant is None or not os.path.exists(tenant_db_path(tenant)):
+        abort(404)
+    g.tenant = tenant
+    g.db_path = tenant_db_path(tenant)
+
+def database_path():
+    # 今のリクエストが使うDBファイル
+    if not app.config['TENANT_MODE']:
+        return DB_NAME
+    return g.db_path
+
+# プロセス全体で使い回す接続（プリペアドステートメントのキャッシュを保つため）。DBファイルごとに空き接続を持ち、
+# 貸し出し中を含めて TENANT_POOL_SIZE 本まで。上限に達したら最も長く使われていない空き接続から閉じる
+_idle_connections = OrderedDict()  # path -> 空き接続のリスト（末尾が最近返されたDBファイル）
+_open_connections = 0
+_pool_condition = threading.Condition()
+
+def connect_db(path=None):
+    config = app.config
+    synchronous = config['SQLITE_SYNCHRONOUS'].upper()
+    if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError(f'SQLITE_SYNCHRONOUS が不正です: {synchronous}')
+    # 書き込みは BEGIN IMMEDIATE で始め、ロック待ちは busy_timeout に任せる
+    conn = sqlite3.connect(path or DB_NAME,
+                           timeout=config['SQLITE_BUSY_TIMEOUT'] / 1000,
+                           isolation_level='IMMEDIATE',
+                           cached_statements=config['SQLITE_STATEMENT_CACHE'],
+                           check_same_thread=False,  # 接続はプールを通してスレッド間で使い回す（同時に使うのは1スレッドだけ）
+                           factory=instrumentation.InstrumentedConnection if config['INSTRUMENTATION'] else sqlite3.Connection)
+    conn.execute(f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}")
+    conn.execute(f"PRAGMA synchronous = {synchronous}")
+    conn.execute(f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}")
+    return conn
+
+# このプロセスでスキーマ作成・移行を済ませたDBファイル
+_initialized_paths = set()
+_init_lock = threading.Lock()
+
+def ensure_schema(path):
+    # DBファイルごとに、最初に使うときだけ init_db() を通す
+    if path in _initialized_paths:
+        return
+    with _init_lock:
+        if path not in _initialized_paths:
+            init_db(path)
+            _initialized_paths.add(path)
+
+def acquire_connection(path):
+    # path の空き接続を借りる。無ければ開く（上限に達していれば他の空き接続を閉じるか、返されるまで待つ）
+    global _open_connections
+    deadline = time.monotonic() + app.config['SQLITE_BUSY_TIMEOUT'] / 1000
+    with _pool_condition:
+        while True:
+            idle = _idle_connections.get(path)
+            if idle:
+                conn = idle.pop()
+                if not idle:
+                    del _idle_connections[path]
+                return conn
+            if _open_connections < app.config['TENANT_POOL_SIZE']:
+                _open_connections += 1
+                break
+            if _idle_connections:
+                oldest_path, oldest = next(iter(_idle_connections.items()))
+                oldest.pop(0).close()
+                if not oldest:
+                    del _idle_connections[oldest_path]
+                _open_connections -= 1
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise sqlite3.OperationalError('DB接続数が上限（TENANT_POOL_SIZE）に達しています')
+            _pool_condition.wait(remaining)
+    try:
+        return connect_db(path)
+    except Exception:
+        with _pool_condition:
+            _open_connections -= 1
+            _pool_condition.notify()
+        raise
+
+def release_connection(path, conn):
+    with _pool_condition:
+        _idle_connections.setdefault(path, []).append(conn)
+        _idle_connections.move_to_end(path)
+        _pool_condition.notify()
+
+def close_idle_connections():
+    # 空いている接続をすべて閉じる（DBファイルを消す前など）
+    global _open_connections
+    with _pool_condition:
+        for idle in _idle_connections.values():
+            for conn in idle:
+                conn.close()
+            _open_connections -= len(idle)
+        _idle_connections.clear()
+        _pool_condition.notify_all()
+
+def get_db():
+    # リクエスト中は同じ接続を使う（接続自体はプールから借りて再利用）
+    if 'db' not in g:
+        path = database_path()
+        ensure_schema(path)
+        g.db = acquire_connection(path)
+        g.db_pool_path = path
+    return g.db
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
+@app.teardown_appcontext
+def release_db(exc):
+    # コミットされなかった書き込みは捨てて、接続はプールに返す
+    conn = g.pop('db', None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        release_connection(g.pop('db_pool_path'), conn)
+
+def init_db(path=None):
+    conn = connect_db(path)
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS records (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -16,7 +235,9 @@ def init_db():
                     category TEXT,
                     subcategory TEXT,
                     amount INTEGER,
-                    memo TEXT
+                    memo TEXT,
+                    month TEXT GENERATED ALWAYS AS (strftime('%Y-%m', date)) VIRTUAL,
+                    year INTEGER GENERATED ALWAYS AS (CAST(strftime('%Y', date) AS INTEGER)) VIRTUAL
                 )''')
     c.execute('''CREATE TABLE IF NOT EXISTS settings (
                     id INTEGER PRIMARY KEY CHECK (id = 1),
@@ -35,127 +256,741 @@ def init_db():
         c.execute("ALTER TABLE records ADD COLUMN subcategory TEXT")
     except sqlite3.OperationalError:
         pass  # カラムが既に存在する場合はスキップ
+    # 期間の正規化カラム（日付から自動計算されるので既存行の埋め直しは不要）
+    for column in ("month TEXT GENERATED ALWAYS AS (strftime('%Y-%m', date)) VIRTUAL",
+                   "year INTEGER GENERATED ALWAYS AS (CAST(strftime('%Y', date) AS INTEGER)) VIRTUAL"):
+        try:
+            c.execute(f"ALTER TABLE records ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass  # カラムが既に存在する場合はスキップ
+    # 一覧の並び替え・キーセットページング用インデックス（末尾には暗黙に id が付くので ORDER BY <列>, id をそのまま読める）
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_date ON records (date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_category ON records (category)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_amount ON records (amount)")
+    # 区分で絞った一覧を日付・金額で並べる用（区分 → 並び替えキー → id の順に読める）
+    # 全文検索で絞ったときは一致した行だけを一時B-treeで並べ替える（一致件数に比例）
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_category_date ON records (category, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_category_amount ON records (category, amount)")
+    # 月・年での絞り込みや予算との突き合わせ用インデックス
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_month ON records (month, category, subcategory)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_year ON records (year)")
+    # 月次集計の最小・最大を数え直す用。集計キーと同じ COALESCE の式で引けるようにする（NULL と空文字は同じグループ）
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_rollup ON records (month, COALESCE(category, ''), COALESCE(subcategory, ''), amount)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_budgets_month ON budgets (month)")
+    # CSV インポートの重複判定用インデックス（日付・金額・区分で候補を絞る）
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_dedupe ON records (date, amount, category)")
+    # メモ・サブカテゴリの全文検索インデックス（日本語向けに trigram）
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'records_fts'")
+    fts_exists = c.fetchone() is not None
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5(
+                    memo, subcategory,
+                    content='records', content_rowid='id', tokenize='trigram'
+                )''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS records_fts_insert AFTER INSERT ON records BEGIN
+                    INSERT INTO records_fts (rowid, memo, subcategory) VALUES (NEW.id, NEW.memo, NEW.subcategory);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS records_fts_delete AFTER DELETE ON records BEGIN
+                    INSERT INTO records_fts (records_fts, rowid, memo, subcategory)
+                    VALUES ('delete', OLD.id, OLD.memo, OLD.subcategory);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS records_fts_update AFTER UPDATE OF memo, subcategory ON records BEGIN
+                    INSERT INTO records_fts (records_fts, rowid, memo, subcategory)
+                    VALUES ('delete', OLD.id, OLD.memo, OLD.subcategory);
+                    INSERT INTO records_fts (rowid, memo, subcategory) VALUES (NEW.id, NEW.memo, NEW.subcategory);
+                 END''')
+    if not fts_exists:
+        c.execute("INSERT INTO records_fts (records_fts) VALUES ('rebuild')")
+    # データ版数と最終更新時刻（書き込みのたびに更新し、キャッシュのキーや ETag に使う）
+    # archiving は締め処理でアーカイブへ移している間だけ 1 にする（集計・ロックのトリガーを止める）
+    for column in ("data_version INTEGER NOT NULL DEFAULT 0", "updated_at INTEGER",
+                   "archiving INTEGER NOT NULL DEFAULT 0"):
+        try:
+            c.execute(f"ALTER TABLE settings ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass  # カラムが既に存在する場合はスキップ
     c.execute("INSERT OR IGNORE INTO settings (id, initial_fee) VALUES (1, 100000)")
+    # 期間の締め（締めた時点の残高と区分別合計のスナップショット。変更不可）
+    c.execute('''CREATE TABLE IF NOT EXISTS period_closes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    through_month TEXT NOT NULL UNIQUE,
+                    closed_at TEXT NOT NULL,
+                    income INTEGER NOT NULL,
+                    expense INTEGER NOT NULL,
+                    record_count INTEGER NOT NULL,
+                    cumulative_income INTEGER NOT NULL,
+                    cumulative_expense INTEGER NOT NULL,
+                    archived INTEGER NOT NULL DEFAULT 0
+                )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS period_close_totals (
+                    close_id INTEGER NOT NULL REFERENCES period_closes (id),
+                    category TEXT NOT NULL,
+                    subcategory TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    total INTEGER NOT NULL,
+                    PRIMARY KEY (close_id, category, subcategory)
+                )''')
+    for table in ('period_closes', 'period_close_totals'):
+        for event in ('UPDATE', 'DELETE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_immutable_{event.lower()} BEFORE {event} ON {table} BEGIN
+                            SELECT RAISE(ABORT, '締めのスナップショットは変更できません');
+                         END''')
+    # 締めた期間の記録の移動先
+    c.execute('''CREATE TABLE IF NOT EXISTS records_archive (
+                    id INTEGER PRIMARY KEY,
+                    date TEXT,
+                    category TEXT,
+                    subcategory TEXT,
+                    amount INTEGER,
+                    memo TEXT,
+                    close_id INTEGER REFERENCES period_closes (id)
+                )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_records_archive_date ON records_archive (date)")
+    create_close_lock_triggers(c)
+    # 月次集計テーブル（ダッシュボード・グラフ・レポートはここから読む）
+    c.execute('''CREATE TABLE IF NOT EXISTS monthly_rollup (
+                    month TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    subcategory TEXT NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    min_amount INTEGER,
+                    max_amount INTEGER,
+                    PRIMARY KEY (month, category, subcategory)
+                )''')
+    create_rollup_triggers(c)
+    # 月ごとの最終変更（分析用スナップショットが変わった月だけ読み直すため）
+    c.execute('''CREATE TABLE IF NOT EXISTS record_changes (
+                    month TEXT PRIMARY KEY,
+                    data_version INTEGER NOT NULL
+                )''')
+    create_change_triggers(c)
+    # 既存データがあるのに集計が空なら作り直す
+    c.execute("SELECT EXISTS (SELECT 1 FROM records) AND NOT EXISTS (SELECT 1 FROM monthly_rollup)")
+    if c.fetchone()[0]:
+        rebuild_rollup(c)
     conn.commit()
     conn.close()
 
-@app.route('/')
-def index():
-    conn = sqlite3.connect(DB_NAME)
+# 集計キー（NULL は空文字にそろえる）
+ROLLUP_KEY = {
+    'month': "COALESCE({row}.month, '')",
+    'category': "COALESCE({row}.category, '')",
+    'subcategory': "COALESCE({row}.subcategory, '')",
+}
+
+def _rollup_key_match(row):
+    return " AND ".join(f"{col} = {expr.format(row=row)}" for col, expr in ROLLUP_KEY.items())
+
+def _rollup_add_sql(row):
+    # 1行分を集計に加える
+    month, category, subcategory = (expr.format(row=row) for expr in ROLLUP_KEY.values())
+    return f'''
+        INSERT INTO monthly_rollup (month, category, subcategory, count, total, min_amount, max_amount)
+        VALUES ({month}, {category}, {subcategory}, 1, CAST(COALESCE({row}.amount, 0) AS INTEGER), {row}.amount, {row}.amount)
+        ON CONFLICT (month, category, subcategory) DO UPDATE SET
+            count = count + 1,
+            total = total + excluded.total,
+            min_amount = CASE WHEN min_amount IS NULL THEN excluded.min_amount
+                              WHEN excluded.min_amount IS NULL THEN min_amount
+                              ELSE MIN(min_amount, excluded.min_amount) END,
+            max_amount = CASE WHEN max_amount IS NULL THEN excluded.max_amount
+                              WHEN excluded.max_amount IS NULL THEN max_amount
+                              ELSE MAX(max_amount, excluded.max_amount) END;'''
+
+def _rollup_remove_sql(row):
+    # 1行分を集計から引く。最小・最大を削った場合だけ該当グループを数え直す
+    group = (f"r.month IS {row}.month"
+             f" AND COALESCE(r.category, '') = {ROLLUP_KEY['category'].format(row=row)}"
+             f" AND COALESCE(r.subcategory, '') = {ROLLUP_KEY['subcategory'].format(row=row)}")
+    key = _rollup_key_match(row)
+    return f'''
+        UPDATE monthly_rollup SET count = count - 1, total = total - CAST(COALESCE({row}.amount, 0) AS INTEGER)
+        WHERE {key};
+        UPDATE monthly_rollup SET
+            min_amount = (SELECT MIN(r.amount) FROM records r WHERE {group}),
+            max_amount = (SELECT MAX(r.amount) FROM records r WHERE {group})
+        WHERE {key} AND ({row}.amount <= min_amount OR {row}.amount >= max_amount);
+        DELETE FROM monthly_rollup WHERE {key} AND count <= 0;'''
+
+def create_close_lock_triggers(c):
+    # 締めた月の記録は追加・編集・削除できないようにする（アーカイブへの移動は除く）
+    closed = "(SELECT MAX(through_month) FROM period_closes)"
+    c.execute("DROP TRIGGER IF EXISTS records_close_lock_insert")
+    c.execute("DROP TRIGGER IF EXISTS records_close_lock_update")
+    c.execute("DROP TRIGGER IF EXISTS records_close_lock_delete")
+    c.execute(f'''CREATE TRIGGER records_close_lock_insert BEFORE INSERT ON records
+                  WHEN strftime('%Y-%m', NEW.date) <= {closed} BEGIN
+                      SELECT RAISE(ABORT, '締め済みの期間には登録できません');
+                  END''')
+    c.execute(f'''CREATE TRIGGER records_close_lock_update BEFORE UPDATE ON records
+                  WHEN strftime('%Y-%m', OLD.date) <= {closed} OR strftime('%Y-%m', NEW.date) <= {closed} BEGIN
+                      SELECT RAISE(ABORT, '締め済みの期間の記録は変更できません');
+                  END''')
+    c.execute(f'''CREATE TRIGGER records_close_lock_delete BEFORE DELETE ON records
+                  WHEN (SELECT archiving FROM settings WHERE id = 1) = 0 AND strftime('%Y-%m', OLD.date) <= {closed} BEGIN
+                      SELECT RAISE(ABORT, '締め済みの期間の記録は削除できません');
+                  END''')
+
+def create_rollup_triggers(c):
+    # 追加・編集・削除・インポートのどの書き込みも同じトランザクション内で集計を更新する
+    c.execute("DROP TRIGGER IF EXISTS records_rollup_insert")
+    c.execute("DROP TRIGGER IF EXISTS records_rollup_delete")
+    c.execute("DROP TRIGGER IF EXISTS records_rollup_update")
+    c.execute(f"CREATE TRIGGER records_rollup_insert AFTER INSERT ON records BEGIN {_rollup_add_sql('NEW')} END")
+    # アーカイブへの移動では集計を減らさない（集計は締めた期間も含めて持つ）
+    c.execute(f"CREATE TRIGGER records_rollup_delete AFTER DELETE ON records "
+              f"WHEN (SELECT archiving FROM settings WHERE id = 1) = 0 BEGIN {_rollup_remove_sql('OLD')} END")
+    c.execute(f"CREATE TRIGGER records_rollup_update AFTER UPDATE ON records BEGIN "
+              f"{_rollup_remove_sql('OLD')} {_rollup_add_sql('NEW')} END")
+
+def _mark_changed_sql(row):
+    # 書き込み時点のデータ版数を記録する（コミット前に版数が1つ進む）
+    return (f"INSERT INTO record_changes (month, data_version) "
+            f"SELECT COALESCE({row}.month, ''), data_version FROM settings WHERE id = 1 "
+            f"ON CONFLICT (month) DO UPDATE SET data_version = excluded.data_version;")
+
+def create_change_triggers(c):
+    c.execute("DROP TRIGGER IF EXISTS records_changes_insert")
+    c.execute("DROP TRIGGER IF EXISTS records_changes_delete")
+    c.execute("DROP TRIGGER IF EXISTS records_changes_update")
+    c.execute(f"CREATE TRIGGER records_changes_insert AFTER INSERT ON records BEGIN {_mark_changed_sql('NEW')} END")
+    # アーカイブへの移動は records とアーカイブを合わせた内容を変えないので記録しない
+    c.execute(f"CREATE TRIGGER records_changes_delete AFTER DELETE ON records "
+              f"WHEN (SELECT archiving FROM settings WHERE id = 1) = 0 BEGIN {_mark_changed_sql('OLD')} END")
+    c.execute(f"CREATE TRIGGER records_changes_update AFTER UPDATE ON records BEGIN "
+              f"{_mark_changed_sql('OLD')} {_mark_changed_sql('NEW')} END")
+
+ROLLUP_FROM_RECORDS = '''
+    SELECT COALESCE(month, ''), COALESCE(category, ''), COALESCE(subcategory, ''),
+           COUNT(*), SUM(CAST(COALESCE(amount, 0) AS INTEGER)), MIN(amount), MAX(amount)
+    FROM (SELECT month, category, subcategory, amount FROM records
+          UNION ALL
+          SELECT strftime('%Y-%m', date), category, subcategory, amount FROM records_archive)
+    GROUP BY 1, 2, 3
+'''
+
+def rebuild_rollup(c):
+    c.execute("DELETE FROM monthly_rollup")
+    c.execute("INSERT INTO monthly_rollup (month, category, subcategory, count, total, min_amount, max_amount)"
+              + ROLLUP_FROM_RECORDS)
+
+def verify_rollup(c):
+    # records から計算し直した集計とのずれ（どちらか一方にしかない行）を返す
+    c.execute(f'''
+        SELECT 'missing', * FROM ({ROLLUP_FROM_RECORDS}
+            EXCEPT SELECT month, category, subcategory, count, total, min_amount, max_amount FROM monthly_rollup)
+        UNION ALL
+        SELECT 'stale', * FROM (SELECT month, category, subcategory, count, total, min_amount, max_amount FROM monthly_rollup
+            EXCEPT {ROLLUP_FROM_RECORDS})
+    ''')
+    return c.fetchall()
+
+def cli_db_path(tenant):
+    # CLI の対象DB。--tenant 指定時はその団体のファイル
+    if tenant is None:
+        return DB_NAME
+    path = tenant_db_path(tenant)
+    if not os.path.exists(path):
+        raise click.ClickException(f'団体 {tenant} のDBがありません: {path}')
+    return path
+
+@app.cli.command('rollup')
+@click.option('--verify', is_flag=True, help='作り直さずにずれだけを確認する')
+@click.option('--tenant', help='対象の団体（団体モード時）')
+def rollup_command(verify, tenant):
+    """月次集計テーブルを作り直す（--verify でずれの確認のみ）"""
+    conn = connect_db(cli_db_path(tenant))
     c = conn.cursor()
+    drift = verify_rollup(c)
+    for row in drift:
+        click.echo(' '.join('' if v is None else str(v) for v in row))
+    click.echo(f'ずれ: {len(drift)}件')
+    if not verify:
+        rebuild_rollup(c)
+        bump_data_version(c)
+        conn.commit()
+        click.echo('月次集計を作り直しました')
+    conn.close()
+
+@app.cli.command('close-period')
+@click.argument('month')
+@click.option('--archive', is_flag=True, help='締めた期間の記録をアーカイブ表へ移す')
+@click.option('--tenant', help='対象の団体（団体モード時）')
+def close_period_command(month, archive, tenant):
+    """MONTH（YYYY-MM）までを締めて残高のスナップショットを残す"""
+    conn = connect_db(cli_db_path(tenant))
+    c = conn.cursor()
+    try:
+        result = close_period(c, month, archive)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    bump_data_version(c)
+    conn.commit()
+    conn.close()
+    click.echo(f"{result['through_month']} まで締めました（収入 {result['income']:,} 円 / 支出 {result['expense']:,} 円、"
+               f"アーカイブ {result['archived_records']} 件）")
+
+@app.cli.command('create-tenant')
+@click.argument('tenant')
+def create_tenant_command(tenant):
+    """団体 TENANT のDBファイルを作る（既にあればスキーマの移行だけ行う）"""
+    if not TENANT_PATTERN.fullmatch(tenant):
+        raise click.ClickException('団体名は英小文字・数字・-・_ で指定してください')
+    os.makedirs(app.config['TENANTS_DIR'], exist_ok=True)
+    init_db(tenant_db_path(tenant))
+    click.echo(f'団体 {tenant} を作成しました: {tenant_db_path(tenant)}')
+
+def bump_data_version(c):
+    # 書き込みのたびに呼び、集計キャッシュを無効にする（同じトランザクション内で）
+    c.execute("UPDATE settings SET data_version = data_version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1")
+
+# 書き込みキュー（WRITE_QUEUE 有効時のみ、DBファイルごとに1本。書き込みの無い間はスレッドと接続を閉じている）
+_write_queues = {}
+_write_queues_lock = threading.Lock()
+
+def get_write_queue():
+    with _write_queues_lock:
+        path = database_path()
+        write_queue = _write_queues.get(path)
+        if write_queue is None:
+            write_queue = _write_queues[path] = WriteQueue(
+                lambda: connect_db(path), before_commit=bump_data_version,
+                window_ms=app.config['WRITE_QUEUE_WINDOW_MS'], max_batch=app.config['WRITE_QUEUE_MAX_BATCH'],
+                idle_timeout=app.config['WRITE_QUEUE_IDLE_TIMEOUT'])
+        return write_queue
+
+def run_write(fn):
+    # fn(cursor) を実行してコミットし、データ版数を進める
+    if app.config['WRITE_QUEUE']:
+        result = get_write_queue().submit(fn)
+    else:
+        conn = get_db()
+        c = conn.cursor()
+        result = fn(c)
+        bump_data_version(c)
+        conn.commit()
+    notify_data_changed()
+    return result
+
+def notify_data_changed():
+    # コミット後に呼び、先行計算した集計の作り直しを予約する
+    if app.config['PRECOMPUTE']:
+        get_precomputer().notify(database_path())
+
+def read_data_version():
+    c = get_db().cursor()
+    c.execute("SELECT data_version, updated_at FROM settings WHERE id = 1")
+    return c.fetchone()
+
+def make_etag(data_version, variant=''):
+    # variant は版数のほかに内容を左右するもの（集計のキーに含めた今日の日付など）
+    return f"v{data_version}-{zlib.crc32((request.full_path + variant).encode('utf-8')):08x}"
+
+def cached_response(policy, data_version, updated_at, render, variant=''):
+    # データ版数から ETag / Last-Modified を付け、変更がなければ render() を呼ばずに 304 を返す
+    etag = make_etag(data_version, variant)
+    # variant があると更新時刻だけでは内容の同一性を判断できないので Last-Modified は付けない
+    last_modified = datetime.fromtimestamp(updated_at, timezone.utc) if updated_at and not variant else None
+    cache_control = app.config['CACHE_CONTROL'][policy]
     
-    # フィルタパラメータ取得
-    search_query = request.args.get('search', '')
-    category_filter = request.args.get('category', '')
-    date_from = request.args.get('date_from', '')
-    date_to = request.args.get('date_to', '')
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = (last_modified is not None and request.if_modified_since is not None
+                        and last_modified.replace(microsecond=0) <= request.if_modified_since)
+    if not_modified:
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def today_variant():
+    # 今日の日付で内容が変わる応答（月末見込みなど）の ETag 用
+    return datetime.now().strftime('%Y-%m-%d')
+
+def conditional(policy, variant=None):
+    # variant() は版数のほかに内容を左右する値を返す（今日の日付など）
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            data_version, updated_at = read_data_version()
+            return cached_response(policy, data_version, updated_at, lambda: view(*args, **kwargs),
+                                   variant() if variant else '')
+        return wrapper
+    return decorator
+
+# 集計結果の先行計算（PRECOMPUTE 有効時のみ、プロセスに1つ）
+_precomputer = None
+_precomputer_lock = threading.Lock()
+
+def run_precompute(path, builder):
+    # builder() を path のDBに対して実行する。リクエスト中ならそのリクエストの接続をそのまま使い
+    # （プールから2本目を借りない）、専用スレッドでは新しいアプリコンテキストを作る
+    if has_app_context() and database_path() == path:
+        data_version, updated_at = read_data_version()
+        return builder(), data_version, updated_at
+    with app.app_context():
+        g.db_path = path
+        data_version, updated_at = read_data_version()
+        return builder(), data_version, updated_at
+
+def precompute_key_current(key):
+    # 集計のキーの最後は今日の日付。日付が変わったキーはもう使われないので捨てる
+    return key[-1] == datetime.now().strftime('%Y-%m-%d')
+
+def get_precomputer():
+    global _precomputer
+    with _precomputer_lock:
+        if _precomputer is None:
+            _precomputer = precompute.Precomputer(
+                run_precompute, debounce_ms=app.config['PRECOMPUTE_DEBOUNCE_MS'],
+                max_staleness=app.config['PRECOMPUTE_MAX_STALENESS'],
+                max_entries=app.config['PRECOMPUTE_MAX_ENTRIES'], is_current=precompute_key_current)
+        return _precomputer
+
+def precomputed(key, builder, data_version, updated_at, fresh=False):
+    # (Entry, 古いかどうか) を返す。fresh なら古い集計は使わない（自分の書き込み直後の表示など）
+    if not app.config['PRECOMPUTE']:
+        return precompute.Entry(builder(), data_version, updated_at, time.time()), False
+    return get_precomputer().get(database_path(), key, builder, data_version,
+                                 max_staleness=0 if fresh else None)
+
+def render_precomputed(template, key, builder, fresh=False, policy='reports'):
+    # 今のデータ版数の ETag と一致すれば集計に触れずに 304 を返す。それ以外は先行計算した集計を使い、
+    # 集計に使ったデータ版数とキーで ETag を付けて、集計した時刻と経過秒数を添えて描画する
+    variant = repr(key)
+    data_version, updated_at = read_data_version()
+    if request.if_none_match and request.if_none_match.contains(make_etag(data_version, variant)):
+        return cached_response(policy, data_version, updated_at, None, variant)
+    entry, stale = precomputed(key, builder, data_version, updated_at, fresh)
+    return cached_response(policy, entry.data_version, entry.updated_at, lambda: render_template(
+        template, **entry.payload, computed_at=datetime.fromtimestamp(entry.built_at).strftime('%H:%M:%S'),
+        computed_age=int(entry.age), stale=stale), variant)
+
+# ダッシュボード統計のキャッシュ（DBファイルごとに、データ版数と今月をキーにする）
+_stats_cache = {'entries': OrderedDict(), 'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+def last_period_close(c):
+    # (締めた最後の月, 累計収入, 累計支出)。締めがなければ ('', 0, 0)
+    c.execute("""
+        SELECT through_month, cumulative_income, cumulative_expense
+        FROM period_closes ORDER BY through_month DESC LIMIT 1
+    """)
+    return c.fetchone() or ('', 0, 0)
+
+def close_period(c, through_month, archive=False):
+    # through_month までを締め、残高と区分別合計のスナップショットを残す。archive なら記録をアーカイブへ移す
+    closed_month, closed_income, closed_expense = last_period_close(c)
+    if not MONTH_PATTERN.match(through_month):
+        raise ValueError(f'年月が不正です: {through_month}')
+    if through_month <= closed_month:
+        raise ValueError(f'{closed_month} まで締め済みです')
+    if through_month >= datetime.now().strftime('%Y-%m'):
+        raise ValueError('今月以降は締められません')
     
-    # クエリ構築
-    query = "SELECT * FROM records WHERE 1=1"
+    c.execute("""
+        SELECT category, subcategory, SUM(count), SUM(total)
+        FROM monthly_rollup
+        WHERE month > ? AND month <= ? AND month != ''
+        GROUP BY category, subcategory
+    """, (closed_month, through_month))
+    totals = c.fetchall()
+    income = sum(total for category, _, _, total in totals if category == '収入')
+    expense = sum(total for category, _, _, total in totals if category == '支出')
+    record_count = sum(count for _, _, count, _ in totals)
+    
+    c.execute("""
+        INSERT INTO period_closes (through_month, closed_at, income, expense, record_count,
+                                   cumulative_income, cumulative_expense, archived)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (through_month, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), income, expense, record_count,
+          closed_income + income, closed_expense + expense, int(archive)))
+    close_id = c.lastrowid
+    c.executemany("INSERT INTO period_close_totals (close_id, category, subcategory, count, total) VALUES (?, ?, ?, ?, ?)",
+                  [(close_id, category, subcategory, count, total) for category, subcategory, count, total in totals])
+    
+    archived = 0
+    if archive:
+        c.execute("UPDATE settings SET archiving = 1 WHERE id = 1")
+        c.execute("""
+            INSERT INTO records_archive (id, date, category, subcategory, amount, memo, close_id)
+            SELECT id, date, category, subcategory, amount, memo, ? FROM records WHERE month <= ?
+        """, (close_id, through_month))
+        c.execute("DELETE FROM records WHERE month <= ?", (through_month,))
+        archived = c.rowcount
+        c.execute("UPDATE settings SET archiving = 0 WHERE id = 1")
+    
+    return {
+        'id': close_id,
+        'through_month': through_month,
+        'income': income,
+        'expense': expense,
+        'record_count': record_count,
+        'cumulative_income': closed_income + income,
+        'cumulative_expense': closed_expense + expense,
+        'archived_records': archived,
+    }
+
+def compute_dashboard_stats(c, current_month):
+    # 収入・支出の合計は最後の締めのスナップショット＋締め後の月の集計
+    closed_month, closed_income, closed_expense = last_period_close(c)
+    
+    # 集計値は条件付き集計1回でまとめて計算する
+    c.execute("""
+        SELECT SUM(CASE WHEN category='収入' AND (month > ? OR month = '') THEN total END),
+               SUM(CASE WHEN category='支出' AND (month > ? OR month = '') THEN total END),
+               SUM(count),
+               1.0 * SUM(CASE WHEN category='支出' THEN total END) / SUM(CASE WHEN category='支出' THEN count END),
+               MAX(CASE WHEN category='支出' THEN max_amount END),
+               MIN(CASE WHEN category='支出' THEN min_amount END),
+               1.0 * SUM(CASE WHEN category='収入' THEN total END) / SUM(CASE WHEN category='収入' THEN count END),
+               SUM(CASE WHEN category='収入' AND month = ? THEN total END),
+               SUM(CASE WHEN category='支出' AND month = ? THEN total END)
+        FROM monthly_rollup
+    """, (closed_month, closed_month, current_month, current_month))
+    (open_income, open_expense, total_records, avg_expense, max_expense, min_expense,
+     avg_income, month_income, month_expense) = c.fetchone()
+    
+    # 月次・カテゴリ別は (月, 区分) の集計1回から作る
+    c.execute("""
+        SELECT month, category, SUM(total) as total
+        FROM monthly_rollup
+        GROUP BY month, category
+        ORDER BY month DESC
+    """)
+    month_category = c.fetchall()
+    category_totals = {}
+    for _, category, total in month_category:
+        category_totals[category] = category_totals.get(category, 0) + total
+    
+    return {
+        'income': closed_income + (open_income or 0),
+        'expense': closed_expense + (open_expense or 0),
+        'total_records': total_records or 0,
+        'avg_expense': int(avg_expense or 0),
+        'max_expense': max_expense or 0,
+        'min_expense': min_expense or 0,
+        'avg_income': avg_income or 0,
+        'month_income': month_income or 0,
+        'month_expense': month_expense or 0,
+        'monthly_data': month_category[:12],
+        'category_stats': list(category_totals.items()),
+    }
+
+def get_dashboard_stats(c, data_version):
+    path = database_path()
+    key = (data_version, datetime.now().strftime('%Y-%m'))
+    entries = _stats_cache['entries']
+    with _stats_lock:
+        entry = entries.get(path)
+        if entry is not None and entry[0] == key:
+            entries.move_to_end(path)
+            _stats_cache['hits'] += 1
+            return entry[1]
+        _stats_cache['misses'] += 1
+    stats = compute_dashboard_stats(c, key[1])
+    with _stats_lock:
+        entries[path] = (key, stats)
+        entries.move_to_end(path)
+        while len(entries) > app.config['TENANT_POOL_SIZE']:
+            entries.popitem(last=False)
+    return stats
+
+PER_PAGE = 20
+# ページ番号のリンクは先頭・末尾と現在のページの前後この数だけ出す
+PAGE_LINK_WINDOW = 2
+# 並び替え可能な列（records の列名）
+SORT_COLUMNS = {'date': 'date', 'amount': 'amount', 'category': 'category'}
+# 一覧の取得列と、その中での並び替えキーの位置
+RECORD_COLUMNS = "id, date, category, subcategory, amount, memo"
+SORT_INDEX = {'date': 1, 'category': 2, 'amount': 4}
+
+# 金額検索（「1000」や「1000-5000」）
+AMOUNT_QUERY = re.compile(r'^[¥￥]?(\d[\d,]*)(?:\s*[-~〜]\s*[¥￥]?(\d[\d,]*))?円?$')
+# trigram で検索できる最短の文字数
+FTS_MIN_TERM_LENGTH = 3
+
+def fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+# snippet() で一致箇所を囲む印（HTML のタグは本文をエスケープしてから付ける）
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+def highlight_snippet(text):
+    # メモ・サブカテゴリは利用者の入力なので、エスケープした上で一致箇所だけを <mark> にする
+    if text is None:
+        return None
+    return str(escape(text)).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+def build_search_filter(search_query, fts=True):
+    # 数字だけなら金額の範囲条件、それ以外はメモ・サブカテゴリの全文検索にする
+    # （全文検索インデックスのないアーカイブでは fts=False で LIKE にする）
+    match = AMOUNT_QUERY.match(search_query)
+    if match:
+        low = int(match.group(1).replace(',', ''))
+        high = int(match.group(2).replace(',', '')) if match.group(2) else low
+        return "amount BETWEEN ? AND ?", [min(low, high), max(low, high)]
+    
+    clauses = []
+    params = []
+    fts_terms = []
+    for term in search_query.split():
+        if fts and len(term) >= FTS_MIN_TERM_LENGTH:
+            fts_terms.append(fts_phrase(term))
+        else:
+            # 短すぎる語は trigram に載らないので LIKE で絞る
+            clauses.append("(memo LIKE ? OR subcategory LIKE ?)")
+            params.extend([f'%{term}%', f'%{term}%'])
+    if fts_terms:
+        clauses.insert(0, "id IN (SELECT rowid FROM records_fts WHERE records_fts MATCH ?)")
+        params.insert(0, ' AND '.join(fts_terms))
+    return '(' + ' AND '.join(clauses) + ')', params
+
+def build_record_filters(args, fts=True):
+    # 一覧と同じ検索・フィルタ条件から WHERE 句とパラメータを組み立てる
+    where = "1=1"
     params = []
     
+    search_query = args.get('search', '').strip()
     if search_query:
-        query += " AND (memo LIKE ? OR amount LIKE ?)"
-        params.extend([f'%{search_query}%', f'%{search_query}%'])
+        search_where, search_params = build_search_filter(search_query, fts)
+        where += f" AND {search_where}"
+        params.extend(search_params)
     
+    category_filter = args.get('category', '')
     if category_filter:
-        query += " AND category = ?"
+        where += " AND category = ?"
         params.append(category_filter)
     
+    date_from = args.get('date_from', '')
     if date_from:
-        query += " AND date >= ?"
+        where += " AND date >= ?"
         params.append(date_from)
     
+    date_to = args.get('date_to', '')
     if date_to:
-        query += " AND date <= ?"
+        where += " AND date <= ?"
         params.append(date_to)
     
-    query += " ORDER BY date DESC"
-    c.execute(query, params)
-    records = c.fetchall()
+    return where, params
+
+def make_page_cursor(record, sort_by):
+    # カーソルは「並び替えキー~id」の文字列
+    key = record[SORT_INDEX[sort_by]]
+    return f"{'' if key is None else key}~{record[0]}"
+
+def page_links(current_page, total_pages):
+    # 表示するページ番号（間が空くところは None）
+    pages = sorted({1, total_pages} | set(range(max(current_page - PAGE_LINK_WINDOW, 1),
+                                                  min(current_page + PAGE_LINK_WINDOW, total_pages) + 1)))
+    links = []
+    for page in pages:
+        if links and page > links[-1] + 1:
+            links.append(None)
+        links.append(page)
+    return links
+
+def parse_page_cursor(cursor, sort_by):
+    if not cursor or '~' not in cursor:
+        return None
+    key, _, last_id = cursor.rpartition('~')
+    try:
+        last_id = int(last_id)
+        if sort_by == 'amount':
+            key = int(key)
+    except ValueError:
+        return None
+    return key, last_id
+
+@app.route('/')
+def index():
+    conn = get_db()
+    c = conn.cursor()
     
-    # 統計データ
-    c.execute("SELECT SUM(amount) FROM records WHERE category='収入'")
-    income = c.fetchone()[0] or 0
-    c.execute("SELECT SUM(amount) FROM records WHERE category='支出'")
-    expense = c.fetchone()[0] or 0
-    balance = income - expense
-    c.execute("SELECT initial_fee FROM settings WHERE id = 1")
-    initial_fee = c.fetchone()[0]
-    remaining_fee = initial_fee + balance
+    # フィルタパラメータ取得
+    search_query = request.args.get('search', '')
+    category_filter = request.args.get('category', '')
+    date_from = request.args.get('date_from', '')
+    date_to = request.args.get('date_to', '')
+    where, params = build_record_filters(request.args)
     
-    # 詳細統計
-    c.execute("SELECT COUNT(*) FROM records")
-    total_records = c.fetchone()[0] or 0
-    c.execute("SELECT AVG(amount) FROM records WHERE category='支出'")
-    avg_expense = int(c.fetchone()[0] or 0)
-    c.execute("SELECT MAX(amount) FROM records WHERE category='支出'")
-    max_expense = c.fetchone()[0] or 0
-    c.execute("SELECT MIN(amount) FROM records WHERE category='支出'")
-    min_expense = c.fetchone()[0] or 0
-    c.execute("SELECT AVG(amount) FROM records WHERE category='収入'")
-    avg_income = c.fetchone()[0] or 0
-    
-    # 今月のデータ
-    current_month = datetime.now().strftime('%Y-%m')
-    c.execute("SELECT SUM(amount) FROM records WHERE category='収入' AND strftime('%Y-%m', date) = ?", (current_month,))
-    month_income = c.fetchone()[0] or 0
-    c.execute("SELECT SUM(amount) FROM records WHERE category='支出' AND strftime('%Y-%m', date) = ?", (current_month,))
-    month_expense = c.fetchone()[0] or 0
+    # 並び替え（列名はホワイトリストから選ぶ）
+    sort_by = request.args.get('sort', 'date')
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'date'
+    sort_order = request.args.get('order', 'desc')
+    if sort_order not in ('asc', 'desc'):
+        sort_order = 'desc'
+    sort_column = SORT_COLUMNS[sort_by]
+    direction = sort_order.upper()
     
-    # 月次データ（グラフ用）
-    c.execute("""
-        SELECT strftime('%Y-%m', date) as month, 
-               category,
-               SUM(amount) as total
-        FROM records 
-        GROUP BY month, category
-        ORDER BY month DESC
-        LIMIT 12
-    """)
-    monthly_data = c.fetchall()
+    # ページネーション（件数はCOUNTで取得）
+    page = max(request.args.get('page', 1, type=int) or 1, 1)
+    c.execute(f"SELECT COUNT(*) FROM records WHERE {where}", params)
+    filtered_count = c.fetchone()[0]
+    total_pages = (filtered_count + PER_PAGE - 1) // PER_PAGE
     
-    # カテゴリ別統計
-    c.execute("""
-        SELECT category, SUM(amount) as total
-        FROM records
-        GROUP BY category
-    """)
-    category_stats = c.fetchall()
+    # キーセットカーソルがあれば「最後に見た並び替えキー＋id」の続きから、
+    # before があれば「最初に見た並び替えキー＋id」の手前から（逆順に読んで並べ直す）取得
+    query = f"SELECT {RECORD_COLUMNS} FROM records WHERE {where}"
+    page_params = list(params)
+    cursor_key = parse_page_cursor(request.args.get('cursor', ''), sort_by)
+    before_key = parse_page_cursor(request.args.get('before', ''), sort_by) if cursor_key is None else None
+    backward = before_key is not None
+    if cursor_key is not None or backward:
+        op = '<' if (sort_order == 'desc') != backward else '>'
+        query += f" AND ({sort_column}, id) {op} (?, ?)"
+        page_params.extend(cursor_key or before_key)
+        offset = 0
+    else:
+        offset = (page - 1) * PER_PAGE
+    read_direction = ('ASC' if direction == 'DESC' else 'DESC') if backward else direction
+    query += f" ORDER BY {sort_column} {read_direction}, id {read_direction} LIMIT ? OFFSET ?"
+    page_params.extend([PER_PAGE, offset])
+    c.execute(query, page_params)
+    paginated_records = c.fetchall()
+    if backward:
+        paginated_records.reverse()
     
-    # 並び替え
-    sort_by = request.args.get('sort', 'date')
-    sort_order = request.args.get('order', 'desc')
+    # 次ページ用のカーソル
+    next_cursor = ''
+    if paginated_records and page < total_pages:
+        last = paginated_records[-1]
+        next_cursor = make_page_cursor(last, sort_by)
+    prev_cursor = ''
+    if paginated_records and page > 1:
+        prev_cursor = make_page_cursor(paginated_records[0], sort_by)
     
-    if sort_by == 'date':
-        records = sorted(records, key=lambda x: x[1], reverse=(sort_order == 'desc'))
-    elif sort_by == 'amount':
-        records = sorted(records, key=lambda x: x[4] if len(x) > 4 else 0, reverse=(sort_order == 'desc'))
-    elif sort_by == 'category':
-        records = sorted(records, key=lambda x: x[2], reverse=(sort_order == 'desc'))
-    
-    # ページネーション
-    page = int(request.args.get('page', 1))
-    per_page = 20
-    total_pages = (len(records) + per_page - 1) // per_page
-    start_idx = (page - 1) * per_page
-    end_idx = start_idx + per_page
-    paginated_records = records[start_idx:end_idx]
+    # 統計データ（データ版数が変わるまではキャッシュを使う）
+    c.execute("SELECT initial_fee, data_version FROM settings WHERE id = 1")
+    initial_fee, data_version = c.fetchone()
+    stats = get_dashboard_stats(c, data_version)
+    income = stats['income']
+    expense = stats['expense']
+    balance = income - expense
+    remaining_fee = initial_fee + balance
     
     # インポート通知
     imported = request.args.get('imported', '')
     
-    conn.close()
     return render_template('index.html', records=paginated_records, income=income, expense=expense,
                            balance=balance, initial_fee=initial_fee, remaining_fee=remaining_fee,
                            last_update=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                           monthly_data=monthly_data, category_stats=category_stats,
+                           monthly_data=stats['monthly_data'], category_stats=stats['category_stats'],
                            search_query=search_query, category_filter=category_filter,
                            date_from=date_from, date_to=date_to,
-                           total_records=total_records, avg_expense=avg_expense, max_expense=max_expense,
-                           min_expense=min_expense, avg_income=avg_income,
-                           month_income=month_income, month_expense=month_expense,
-                           current_page=page, total_pages=total_pages,
+                           total_records=stats['total_records'], avg_expense=stats['avg_expense'],
+                           max_expense=stats['max_expense'], min_expense=stats['min_expense'],
+                           avg_income=stats['avg_income'],
+                           month_income=stats['month_income'], month_expense=stats['month_expense'],
+                           current_page=page, total_pages=total_pages, page_links=page_links(page, total_pages),
+                           next_cursor=next_cursor, prev_cursor=prev_cursor,
                            sort_by=sort_by, sort_order=sort_order, imported=imported)
 
 @app.route('/add', methods=['GET', 'POST'])
@@ -168,12 +1003,9 @@ def add():
             subcategory = request.form.get('subcategory', '')
             amount = request.form['amount']
             memo = request.form['memo']
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute("INSERT INTO records (date, category, subcategory, amount, memo) VALUES (?, ?, ?, ?, ?)",
-                      (date, category, subcategory, amount, memo))
-            conn.commit()
-            conn.close()
+            run_write(lambda c: c.execute(
+                "INSERT INTO records (date, category, subcategory, amount, memo) VALUES (?, ?, ?, ?, ?)",
+                (date, category, subcategory, amount, memo)))
         # 複数登録
         elif 'multi' in request.form:
             dates = request.form.getlist('date[]')
@@ -181,100 +1013,206 @@ def add():
             subcategories = request.form.getlist('subcategory[]')
             amounts = request.form.getlist('amount[]')
             memos = request.form.getlist('memo[]')
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            for d, cat, subcat, amt, mem in zip(dates, categories, subcategories, amounts, memos):
-                c.execute("INSERT INTO records (date, category, subcategory, amount, memo) VALUES (?, ?, ?, ?, ?)",
-                          (d, cat, subcat or '', amt, mem))
-            conn.commit()
-            conn.close()
-        return redirect('/')
+            rows = [(d, cat, subcat or '', amt, mem)
+                    for d, cat, subcat, amt, mem in zip(dates, categories, subcategories, amounts, memos)]
+            run_write(lambda c: c.executemany(
+                "INSERT INTO records (date, category, subcategory, amount, memo) VALUES (?, ?, ?, ?, ?)", rows))
+        return redirect(url_for('index'))
     return render_template('add.html')
 
 @app.route('/set_fee', methods=['GET', 'POST'])
 def set_fee():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
     if request.method == 'POST':
         new_fee = request.form['initial_fee']
-        c.execute("UPDATE settings SET initial_fee = ? WHERE id = 1", (new_fee,))
-        conn.commit()
-        conn.close()
-        return redirect('/')
+        run_write(lambda c: c.execute("UPDATE settings SET initial_fee = ? WHERE id = 1", (new_fee,)))
+        return redirect(url_for('index'))
     else:
+        c = get_db().cursor()
         c.execute("SELECT initial_fee FROM settings WHERE id = 1")
         current_fee = c.fetchone()[0]
-        conn.close()
         return render_template('set_fee.html', current_fee=current_fee)
 
 @app.route('/edit/<int:record_id>', methods=['GET', 'POST'])
 def edit_record(record_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
     if request.method == 'POST':
         date = request.form['date']
         category = request.form['category']
         subcategory = request.form.get('subcategory', '')
         amount = request.form['amount']
         memo = request.form['memo']
-        c.execute("UPDATE records SET date=?, category=?, subcategory=?, amount=?, memo=? WHERE id=?",
-                  (date, category, subcategory, amount, memo, record_id))
-        conn.commit()
-        conn.close()
-        return redirect('/')
+        run_write(lambda c: c.execute(
+            "UPDATE records SET date=?, category=?, subcategory=?, amount=?, memo=? WHERE id=?",
+            (date, category, subcategory, amount, memo, record_id)))
+        return redirect(url_for('index'))
     else:
+        c = get_db().cursor()
         c.execute("SELECT * FROM records WHERE id = ?", (record_id,))
         record = c.fetchone()
-        conn.close()
         if record:
             return render_template('edit.html', record=record)
-        return redirect('/')
+        return redirect(url_for('index'))
 
 @app.route('/delete/<int:record_id>', methods=['POST'])
 def delete_record(record_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM records WHERE id = ?", (record_id,))
-    conn.commit()
-    conn.close()
-    return redirect('/')
+    run_write(lambda c: c.execute("DELETE FROM records WHERE id = ?", (record_id,)))
+    return redirect(url_for('index'))
 
-@app.route('/export')
-def export_csv():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT date, category, subcategory, amount, memo FROM records ORDER BY date DESC")
-    records = c.fetchall()
-    conn.close()
+@app.errorhandler(sqlite3.IntegrityError)
+def integrity_error(e):
+    # 締め済み期間への書き込みなど、トリガーが拒否した変更
+    if request.is_json:
+        return jsonify({'error': str(e)}), 409
+    return render_template('error.html', message=str(e)), 409
+
+@app.route('/close-period', methods=['POST'])
+def close_period_route():
+    data = request.get_json(silent=True) or request.form
+    through_month = data.get('month', '')
+    archive = bool(data.get('archive'))
+    try:
+        result = run_write(lambda c: close_period(c, through_month, archive))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result)
+
+@app.route('/api/period-closes')
+@conditional('api')
+def period_closes():
+    c = get_db().cursor()
+    c.execute("""
+        SELECT id, through_month, closed_at, income, expense, record_count,
+               cumulative_income, cumulative_expense, archived
+        FROM period_closes ORDER BY through_month DESC
+    """)
+    columns = [d[0] for d in c.description]
+    closes = [dict(zip(columns, row)) for row in c.fetchall()]
+    for close in closes:
+        c.execute("SELECT category, subcategory, count, total FROM period_close_totals WHERE close_id = ?",
+                  (close['id'],))
+        close['totals'] = [{'category': r[0], 'subcategory': r[1], 'count': r[2], 'total': r[3]}
+                           for r in c.fetchall()]
+    return jsonify({'closes': closes})
+
+# 一括操作（SET 句はホワイトリストから選ぶ）
+BULK_OPERATIONS = {
+    'set_subcategory': "subcategory = ?",
+    'set_category': "category = ?",
+    'shift_date': "date = date(date, ?)",
+}
+# ids の代わりに対象を選べるフィルタ（一覧と同じ）
+BULK_FILTER_KEYS = ('search', 'category', 'date_from', 'date_to')
+
+@app.route('/bulk', methods=['POST'])
+def bulk_update():
+    # ID一覧または一覧と同じフィルタで対象を選び、1回の UPDATE/DELETE で処理する
+    data = request.get_json(silent=True) or request.form
+    operation = data.get('operation', '')
+    if not isinstance(operation, str) or (operation != 'delete' and operation not in BULK_OPERATIONS):
+        return jsonify({'error': f'不明な操作です: {operation}'}), 400
+    
+    ids = data.get('ids') if request.is_json else request.form.getlist('ids')
+    if ids:
+        # 文字列を渡されると1文字ずつ ID とみなしてしまうので、一覧以外は受け付けない
+        if not isinstance(ids, list) or any(isinstance(i, bool) for i in ids):
+            return jsonify({'error': 'ids は整数の一覧で指定してください'}), 400
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            return jsonify({'error': 'ids は整数の一覧で指定してください'}), 400
+        where, params = "id IN (SELECT value FROM json_each(?))", [json.dumps(ids)]
+    else:
+        if any(not isinstance(data.get(key, ''), str) for key in BULK_FILTER_KEYS):
+            return jsonify({'error': 'フィルタ条件は文字列で指定してください'}), 400
+        if not any(data.get(key) for key in BULK_FILTER_KEYS):
+            return jsonify({'error': 'ids かフィルタ条件のどちらかを指定してください'}), 400
+        where, params = build_record_filters(data)
+    
+    if operation == 'delete':
+        query = f"DELETE FROM records WHERE {where}"
+    else:
+        value = data.get('value', '')
+        if not isinstance(value, (str, int)) or isinstance(value, bool):
+            return jsonify({'error': 'value は文字列か数値で指定してください'}), 400
+        if operation == 'set_category' and value not in ('収入', '支出'):
+            return jsonify({'error': f'区分が不正です: {value}'}), 400
+        if operation == 'shift_date':
+            try:
+                value = f"{int(value):+d} days"
+            except (TypeError, ValueError):
+                return jsonify({'error': 'shift_date の value は日数で指定してください'}), 400
+        query = f"UPDATE records SET {BULK_OPERATIONS[operation]} WHERE {where}"
+        params = [value] + params
     
+    affected = run_write(lambda c: c.execute(query, params).rowcount)
+    return jsonify({'operation': operation, 'affected': affected})
+
+# エクスポート時に一度に読み込む行数
+EXPORT_CHUNK_SIZE = 1000
+
+def generate_csv_rows(query, params):
+    # カーソルから少しずつ読み、CSV の行をそのまま流す
+    c = get_db().cursor()
+    c.execute(query, params)
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(['日付', '区分', 'サブカテゴリ', '金額', 'メモ'])
-    for record in records:
-        writer.writerow(record)
+    yield output.getvalue()
+    while True:
+        rows = c.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        output.seek(0)
+        output.truncate()
+        writer.writerows(rows)
+        yield output.getvalue()
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 で gzip 形式
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/export')
+@conditional('export')
+def export_csv():
+    # 一覧と同じ検索・フィルタ条件で絞り込める。include_archive で締めてアーカイブした記録も含める
+    where, params = build_record_filters(request.args)
+    query = f"SELECT date, category, subcategory, amount, memo FROM records WHERE {where}"
+    if request.args.get('include_archive'):
+        archive_where, archive_params = build_record_filters(request.args, fts=False)
+        query += f" UNION ALL SELECT date, category, subcategory, amount, memo FROM records_archive WHERE {archive_where}"
+        params = params + archive_params
+    rows = generate_csv_rows(query + " ORDER BY date DESC", params)
     
-    output.seek(0)
+    if request.args.get('gzip'):
+        return Response(
+            stream_with_context(gzip_stream(rows)),
+            mimetype='application/gzip',
+            headers={'Content-Disposition': 'attachment; filename=account_records.csv.gz'}
+        )
     return Response(
-        output.getvalue(),
+        stream_with_context(rows),
         mimetype='text/csv',
         headers={'Content-Disposition': 'attachment; filename=account_records.csv'}
     )
 
 @app.route('/api/chart-data')
+@conditional('api')
 def chart_data():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
-        SELECT strftime('%Y-%m', date) as month, 
-               SUM(CASE WHEN category='収入' THEN amount ELSE 0 END) as income,
-               SUM(CASE WHEN category='支出' THEN amount ELSE 0 END) as expense
-        FROM records 
+        SELECT month, 
+               SUM(CASE WHEN category='収入' THEN total ELSE 0 END) as income,
+               SUM(CASE WHEN category='支出' THEN total ELSE 0 END) as expense
+        FROM monthly_rollup 
         GROUP BY month
         ORDER BY month DESC
         LIMIT 12
     """)
     data = c.fetchall()
-    conn.close()
     
     months = [row[0] for row in reversed(data)]
     income = [row[1] for row in reversed(data)]
@@ -287,19 +1225,19 @@ def chart_data():
     })
 
 @app.route('/api/category-pie-data')
+@conditional('api')
 def category_pie_data():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
-        SELECT subcategory, SUM(amount) as total
-        FROM records
-        WHERE category='支出' AND subcategory IS NOT NULL AND subcategory != ''
+        SELECT subcategory, SUM(total) as total
+        FROM monthly_rollup
+        WHERE category='支出' AND subcategory != ''
         GROUP BY subcategory
         ORDER BY total DESC
         LIMIT 10
     """)
     data = c.fetchall()
-    conn.close()
     
     labels = [row[0] for row in data]
     values = [row[1] for row in data]
@@ -309,21 +1247,58 @@ def category_pie_data():
         'values': values
     })
 
+@app.route('/api/search')
+@conditional('api')
+def search_records():
+    # 関連度順の検索結果と、一致箇所を強調した抜粋を返す
+    query = request.args.get('q', '').strip()
+    terms = [fts_phrase(t) for t in query.split() if len(t) >= FTS_MIN_TERM_LENGTH]
+    if not terms:
+        return jsonify({'results': []})
+    limit = min(request.args.get('limit', 20, type=int) or 20, 100)
+    c = get_db().cursor()
+    c.execute("""
+        SELECT r.id, r.date, r.category, r.subcategory, r.amount,
+               snippet(records_fts, 0, ?, ?, '…', 12) as memo_snippet,
+               snippet(records_fts, 1, ?, ?, '…', 12) as subcategory_snippet
+        FROM records_fts
+        JOIN records r ON r.id = records_fts.rowid
+        WHERE records_fts MATCH ?
+        ORDER BY rank
+        LIMIT ?
+    """, (SNIPPET_START, SNIPPET_END, SNIPPET_START, SNIPPET_END, ' OR '.join(terms), limit))
+    results = [
+        {'id': row[0], 'date': row[1], 'category': row[2], 'subcategory': row[3], 'amount': row[4],
+         'memo_snippet': highlight_snippet(row[5]), 'subcategory_snippet': highlight_snippet(row[6])}
+        for row in c.fetchall()
+    ]
+    return jsonify({'results': results})
+
+@app.route('/api/stats-cache')
+def stats_cache():
+    with _stats_lock:
+        entry = _stats_cache['entries'].get(database_path())
+        return jsonify({
+            'hits': _stats_cache['hits'],
+            'misses': _stats_cache['misses'],
+            'data_version': entry[0][0] if entry else None
+        })
+
 @app.route('/api/monthly-trend')
+@conditional('api')
 def monthly_trend():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
-        SELECT strftime('%Y-%m', date) as month,
-               SUM(CASE WHEN category='収入' THEN amount ELSE 0 END) as income,
-               SUM(CASE WHEN category='支出' THEN amount ELSE 0 END) as expense
-        FROM records
+        SELECT month,
+               SUM(CASE WHEN category='収入' THEN total ELSE 0 END) as income,
+               SUM(CASE WHEN category='支出' THEN total ELSE 0 END) as expense
+        FROM monthly_rollup
         GROUP BY month
         ORDER BY month DESC
         LIMIT 6
     """)
     data = c.fetchall()
-    conn.close()
     
     months = [row[0] for row in reversed(data)]
     income = [row[1] for row in reversed(data)]
@@ -337,15 +1312,21 @@ def monthly_trend():
 
 @app.route('/reports')
 def reports():
-    conn = sqlite3.connect(DB_NAME)
+    # 集計は先行計算した結果を使う（今日の日付は見通しに効くのでキーに含める）
+    pivot_args = parse_pivot_args(request.args, default_period='quarter')
+    key = ('reports', tuple(pivot_args.items()), datetime.now().strftime('%Y-%m-%d'))
+    return render_precomputed('reports.html', key, lambda: build_reports(pivot_args))
+
+def build_reports(pivot_args):
+    conn = get_db()
     c = conn.cursor()
     
     # 年次レポート
     c.execute("""
-        SELECT strftime('%Y', date) as year,
-               SUM(CASE WHEN category='収入' THEN amount ELSE 0 END) as income,
-               SUM(CASE WHEN category='支出' THEN amount ELSE 0 END) as expense
-        FROM records
+        SELECT substr(month, 1, 4) as year,
+               SUM(CASE WHEN category='収入' THEN total ELSE 0 END) as income,
+               SUM(CASE WHEN category='支出' THEN total ELSE 0 END) as expense
+        FROM monthly_rollup
         GROUP BY year
         ORDER BY year DESC
     """)
@@ -353,10 +1334,10 @@ def reports():
     
     # 月次レポート（過去12ヶ月）
     c.execute("""
-        SELECT strftime('%Y-%m', date) as month,
-               SUM(CASE WHEN category='収入' THEN amount ELSE 0 END) as income,
-               SUM(CASE WHEN category='支出' THEN amount ELSE 0 END) as expense
-        FROM records
+        SELECT month,
+               SUM(CASE WHEN category='収入' THEN total ELSE 0 END) as income,
+               SUM(CASE WHEN category='支出' THEN total ELSE 0 END) as expense
+        FROM monthly_rollup
         GROUP BY month
         ORDER BY month DESC
         LIMIT 12
@@ -365,23 +1346,141 @@ def reports():
     
     # サブカテゴリ別統計
     c.execute("""
-        SELECT subcategory, COUNT(*) as count, SUM(amount) as total
-        FROM records
-        WHERE category='支出' AND subcategory IS NOT NULL AND subcategory != ''
+        SELECT subcategory, SUM(count) as count, SUM(total) as total
+        FROM monthly_rollup
+        WHERE category='支出' AND subcategory != ''
         GROUP BY subcategory
         ORDER BY total DESC
     """)
     subcategory_stats = c.fetchall()
-    
-    conn.close()
-    return render_template('reports.html', yearly_data=yearly_data,
-                         monthly_report=monthly_report, subcategory_stats=subcategory_stats)
+
+    # 自由集計・移動平均・残高見通し（メモリ上のスナップショットから）
+    snapshot = get_snapshot()
+    pivot_rows = analytics.pivot(snapshot, **pivot_args)
+    rolling = analytics.rolling(snapshot, ROLLING_WINDOW)
+    rolling_averages = {month: (income, expense) for month, income, expense
+                        in zip(rolling['periods'], rolling['income_average'], rolling['expense_average'])}
+    forecast = analytics.forecast(snapshot, read_initial_fee(c), FORECAST_MONTHS, ROLLING_WINDOW)
+
+    return dict(yearly_data=yearly_data,
+                monthly_report=monthly_report, subcategory_stats=subcategory_stats,
+                pivot_args=pivot_args, pivot_rows=pivot_rows, periods=analytics.PERIODS,
+                rolling_window=ROLLING_WINDOW, rolling_averages=rolling_averages, forecast=forecast)
+
+# 分析用スナップショット（DBファイルごと）
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+# 移動平均の月数と、残高見通しの月数
+ROLLING_WINDOW = 3
+FORECAST_MONTHS = 6
+
+def get_snapshot():
+    # データ版数が進んでいれば、版数と記録を同じ読み取りトランザクションで読んで追いつく
+    path = database_path()
+    with _snapshots_lock:
+        snapshot = _snapshots.get(path)
+        if snapshot is None:
+            snapshot = _snapshots[path] = analytics.Snapshot()
+        _snapshots.move_to_end(path)
+        while len(_snapshots) > app.config['TENANT_POOL_SIZE']:
+            _snapshots.popitem(last=False)
+    conn = get_db()
+    with snapshot.lock:
+        c = conn.cursor()
+        c.execute("BEGIN")
+        try:
+            c.execute("SELECT data_version FROM settings WHERE id = 1")
+            snapshot.refresh(c, c.fetchone()[0])
+        finally:
+            conn.rollback()
+    return snapshot
+
+def read_initial_fee(c):
+    c.execute("SELECT initial_fee FROM settings WHERE id = 1")
+    row = c.fetchone()
+    return row[0] if row else 0
+
+def parse_iso_date(value):
+    try:
+        return datetime.strptime(value or '', '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def parse_pivot_args(args, default_period='month'):
+    period = args.get('period', default_period)
+    by = tuple(key for key in args.get('by', 'category').split(',') if key in analytics.GROUP_KEYS)
+    return {
+        'period': period if period in analytics.PERIODS else default_period,
+        'by': by,
+        'start': parse_iso_date(args.get('from')),
+        'end': parse_iso_date(args.get('to')),
+        'category': args.get('category') or None,
+    }
+
+def bounded_int(value, default, low, high):
+    try:
+        return min(max(int(value), low), high)
+    except (TypeError, ValueError):
+        return default
+
+@app.route('/api/analytics/pivot')
+@conditional('api')
+def analytics_pivot():
+    pivot_args = parse_pivot_args(request.args)
+    rows = analytics.pivot(get_snapshot(), **pivot_args)
+    return jsonify({
+        'period': pivot_args['period'],
+        'by': list(pivot_args['by']),
+        'rows': rows,
+    })
+
+@app.route('/api/analytics/rolling')
+@conditional('api')
+def analytics_rolling():
+    window = bounded_int(request.args.get('window'), ROLLING_WINDOW, 1, 24)
+    return jsonify(analytics.rolling(get_snapshot(), window))
+
+@app.route('/api/analytics/forecast')
+@conditional('api')
+def analytics_forecast():
+    months = bounded_int(request.args.get('months'), FORECAST_MONTHS, 1, 36)
+    window = bounded_int(request.args.get('window'), ROLLING_WINDOW, 1, 24)
+    snapshot = get_snapshot()
+    return jsonify(analytics.forecast(snapshot, read_initial_fee(get_db().cursor()), months, window))
+
+MONTH_PATTERN = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+# 予算と実績を比べられる最長の期間（月数）
+MAX_VARIANCE_MONTHS = 120
+
+def parse_month_range(args, default_month):
+    month_from = args.get('from', '')
+    month_to = args.get('to', '')
+    if not MONTH_PATTERN.match(month_from):
+        month_from = default_month
+    if not MONTH_PATTERN.match(month_to):
+        month_to = month_from
+    if month_to < month_from:
+        month_from, month_to = month_to, month_from
+    return month_from, month_to
+
+def load_budget_variance(c, month_from, month_to):
+    # 期間内の予算と、月×区分×サブカテゴリの実績（月次集計）を1回ずつ読み、突き合わせはメモリ上で行う
+    months = budget_variance.month_range(month_from, month_to)[-MAX_VARIANCE_MONTHS:]
+    month_from = months[0]
+    c.execute("""
+        SELECT id, category, subcategory, amount, month, year FROM budgets
+        WHERE month BETWEEN ? AND ?
+           OR (month = '' AND (year IS NULL OR year BETWEEN ? AND ?))
+        ORDER BY year DESC, month DESC
+    """, (month_from, month_to, int(month_from[:4]), int(month_to[:4])))
+    budgets = c.fetchall()
+    c.execute("SELECT month, category, subcategory, total FROM monthly_rollup WHERE month BETWEEN ? AND ?",
+              (month_from, month_to))
+    actuals = c.fetchall()
+    return budgets, budget_variance.compute_variance(budgets, actuals, months)
 
 @app.route('/budget', methods=['GET', 'POST'])
 def budget():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
     if request.method == 'POST':
         category = request.form.get('category', '')
         subcategory = request.form.get('subcategory', '')
@@ -390,75 +1489,265 @@ def budget():
         year = request.form.get('year', datetime.now().year)
         
         if request.form.get('action') == 'add':
-            c.execute("INSERT INTO budgets (category, subcategory, amount, month, year) VALUES (?, ?, ?, ?, ?)",
-                      (category, subcategory, amount, month, year))
+            run_write(lambda c: c.execute(
+                "INSERT INTO budgets (category, subcategory, amount, month, year) VALUES (?, ?, ?, ?, ?)",
+                (category, subcategory, amount, month, year)))
         elif request.form.get('action') == 'delete':
             budget_id = request.form.get('budget_id')
-            c.execute("DELETE FROM budgets WHERE id = ?", (budget_id,))
+            run_write(lambda c: c.execute("DELETE FROM budgets WHERE id = ?", (budget_id,)))
         
-        conn.commit()
-        conn.close()
-        return redirect('/budget')
+        # 自分の変更がすぐ見えるよう、直後の表示だけは古い集計を使わない
+        return redirect(url_for('budget', fresh=1))
     
-    # 予算一覧
+    # 表示期間（既定は今月）。見込みは今日の日付で変わるのでキーに含める
     current_month = datetime.now().strftime('%Y-%m')
-    c.execute("SELECT * FROM budgets WHERE month = ? OR month = '' ORDER BY year DESC, month DESC", (current_month,))
-    budgets = c.fetchall()
+    month_from, month_to = parse_month_range(request.args, current_month)
+    key = ('budget', month_from, month_to, datetime.now().strftime('%Y-%m-%d'))
+    return render_precomputed('budget.html', key, lambda: build_budget(current_month, month_from, month_to),
+                              fresh=request.args.get('fresh') == '1')
+
+def build_budget(current_month, month_from, month_to):
+    c = get_db().cursor()
+    budgets, variance = load_budget_variance(c, month_from, month_to)
+    return dict(budgets=budgets, variance=variance, summary=budget_variance.summarize(variance),
+                current_month=current_month, month_from=month_from, month_to=month_to)
+
+@app.route('/api/budget-variance')
+@conditional('api', variant=today_variant)
+def budget_variance_data():
+    current_month = datetime.now().strftime('%Y-%m')
+    month_from, month_to = parse_month_range(request.args, current_month)
+    _, variance = load_budget_variance(get_db().cursor(), month_from, month_to)
+    return jsonify({
+        'from': month_from,
+        'to': month_to,
+        'summary': budget_variance.summarize(variance),
+        'rows': variance,
+    })
+
+# インポートの一括挿入件数と、画面に出すエラー行の上限
+IMPORT_BATCH_SIZE = 1000
+IMPORT_ERROR_LIMIT = 200
+IMPORT_DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d', '%Y%m%d')
+
+def normalize_import_row(row):
+    # CSV の1行を (date, category, subcategory, amount, memo) にそろえる。不正なら ValueError
+    if len(row) < 3:
+        raise ValueError('列が足りません（日付, 区分, 金額 は必須）')
+    raw_date, category, raw_amount = (v.strip() for v in row[:3])
+    memo = row[3].strip() if len(row) > 3 else ''
+    subcategory = row[4].strip() if len(row) > 4 else ''
     
-    # 予算と実績の比較
-    c.execute("""
-        SELECT b.id, b.category, b.subcategory, b.amount as budget,
-               COALESCE(SUM(r.amount), 0) as actual
-        FROM budgets b
-        LEFT JOIN records r ON r.category = b.category 
-            AND (b.subcategory = '' OR r.subcategory = b.subcategory)
-            AND strftime('%Y-%m', r.date) = b.month
-        WHERE b.month = ? OR b.month = ''
-        GROUP BY b.id
-    """, (current_month,))
-    budget_comparison = c.fetchall()
+    for fmt in IMPORT_DATE_FORMATS:
+        try:
+            date = datetime.strptime(raw_date, fmt).strftime('%Y-%m-%d')
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f'日付が不正です: {raw_date}')
     
-    conn.close()
-    return render_template('budget.html', budgets=budgets, budget_comparison=budget_comparison,
-                         current_month=current_month)
+    if category not in ('収入', '支出'):
+        raise ValueError(f'区分が不正です: {category}')
+    
+    cleaned = raw_amount.replace(',', '').replace('¥', '').replace('￥', '').replace('円', '')
+    try:
+        amount = int(cleaned)
+    except ValueError:
+        raise ValueError(f'金額が不正です: {raw_amount}') from None
+    
+    return date, category, subcategory, amount, memo
+
+IMPORT_STAGING_TABLE = '''CREATE TEMP TABLE IF NOT EXISTS import_staging (
+                            date TEXT,
+                            category TEXT,
+                            subcategory TEXT,
+                            amount INTEGER,
+                            memo TEXT
+                        )'''
+
+def stage_import(conn, csv_reader):
+    # 検証済みの行を一時表 import_staging に一括挿入する。一時表にしか書かないので main の書き込みロックは取らない
+    # （isolation_level='IMMEDIATE' のままだと最初の INSERT で BEGIN IMMEDIATE になるので、ここだけ自分で BEGIN する）
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    c = conn.cursor()
+    try:
+        c.execute(IMPORT_STAGING_TABLE)
+        c.execute("BEGIN")
+        c.execute("DELETE FROM import_staging")
+        closed_month = last_period_close(c)[0]
+        
+        errors = []
+        error_count = 0
+        staged = 0
+        batch = []
+        for line_no, row in enumerate(csv_reader, start=2):  # 1行目はヘッダー
+            if not any(v.strip() for v in row):
+                continue
+            try:
+                record = normalize_import_row(row)
+                if record[0][:7] <= closed_month:
+                    raise ValueError(f'{closed_month} まで締め済みの期間です: {record[0]}')
+                batch.append(record)
+            except ValueError as e:
+                error_count += 1
+                if len(errors) < IMPORT_ERROR_LIMIT:
+                    errors.append((line_no, str(e), ','.join(row)))
+                continue
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                c.executemany("INSERT INTO import_staging VALUES (?, ?, ?, ?, ?)", batch)
+                staged += len(batch)
+                batch = []
+        if batch:
+            c.executemany("INSERT INTO import_staging VALUES (?, ?, ?, ?, ?)", batch)
+            staged += len(batch)
+        c.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+    finally:
+        conn.isolation_level = isolation_level
+    return {
+        'staged': staged,
+        'error_count': error_count,
+        'errors': errors,
+    }
+
+def merge_import(c, staging_conn, dedupe=False):
+    # 一時表の行を records にまとめて移し、取り込んだ件数を返す（run_write の中で呼ぶ）
+    # 書き込みキューの接続からはリクエストの接続の一時表が見えないので、自分の一時表へ写してから移す
+    if c.connection is not staging_conn:
+        c.execute(IMPORT_STAGING_TABLE)
+        c.execute("DELETE FROM import_staging")
+        c.executemany("INSERT INTO import_staging VALUES (?, ?, ?, ?, ?)", staging_conn.execute(
+            "SELECT date, category, subcategory, amount, memo FROM import_staging ORDER BY rowid"))
+    if dedupe:
+        # 同じ日付・区分・サブカテゴリ・金額・メモの既存行があれば取り込まない
+        # 既存行との突き合わせは idx_records_dedupe を使った反結合（日付順に並べて索引を順に読む。同じ日付の中はCSVの順）
+        c.execute('''INSERT INTO records (date, category, subcategory, amount, memo)
+                     SELECT s.date, s.category, s.subcategory, s.amount, s.memo
+                     FROM import_staging s
+                     LEFT JOIN records r
+                       ON r.date = s.date AND r.amount = s.amount AND r.category = s.category
+                      AND COALESCE(r.subcategory, '') = s.subcategory AND COALESCE(r.memo, '') = s.memo
+                     WHERE r.id IS NULL
+                     ORDER BY s.date, s.rowid''')
+    else:
+        c.execute('''INSERT INTO records (date, category, subcategory, amount, memo)
+                     SELECT date, category, subcategory, amount, memo FROM import_staging''')
+    imported = c.rowcount
+    c.execute("DELETE FROM import_staging")
+    return imported
 
 @app.route('/import', methods=['GET', 'POST'])
 def import_csv():
     if request.method == 'POST':
         if 'file' not in request.files:
-            return redirect('/')
+            return redirect(url_for('index'))
         file = request.files['file']
         if file.filename == '':
-            return redirect('/')
+            return redirect(url_for('index'))
         
         if file and file.filename.endswith('.csv'):
-            stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
+            # アップロードは全体を読み込まず、少しずつデコードする
+            stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
             csv_reader = csv.reader(stream)
-            next(csv_reader)  # ヘッダー行をスキップ
             
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            count = 0
-            for row in csv_reader:
-                if len(row) >= 3:
-                    date = row[0]
-                    category = row[1]
-                    amount = row[2]
-                    memo = row[3] if len(row) > 3 else ''
-                    subcategory = row[4] if len(row) > 4 else ''
-                    try:
-                        c.execute("INSERT INTO records (date, category, subcategory, amount, memo) VALUES (?, ?, ?, ?, ?)",
-                                  (date, category, subcategory, amount, memo))
-                        count += 1
-                    except (sqlite3.Error, ValueError) as e:
-                        # 無効なデータはスキップ
-                        continue
-            conn.commit()
-            conn.close()
-            return redirect(f'/?imported={count}')
+            # 読み込みと検証は一時表に対して行い、records への書き込みロックは最後にまとめて移すときだけ取る
+            conn = get_db()
+            try:
+                next(csv_reader, None)  # ヘッダー行をスキップ
+                result = stage_import(conn, csv_reader)
+            except UnicodeDecodeError:
+                # 途中まで取り込むと重複の元になるので、ファイル全体を取り込まない
+                return render_template('import.html', result={
+                    'imported': 0,
+                    'duplicates': 0,
+                    'error_count': 1,
+                    'errors': [(csv_reader.line_num + 1,
+                                'UTF-8 として読めない文字があります（Shift_JIS などは UTF-8 で保存し直してください）。'
+                                'ファイル全体を取り込みませんでした', '')],
+                })
+            dedupe = bool(request.form.get('dedupe'))
+            try:
+                result['imported'] = run_write(lambda c: merge_import(c, conn, dedupe))
+            finally:
+                conn.execute("DROP TABLE IF EXISTS temp.import_staging")
+            result['duplicates'] = result.pop('staged') - result['imported']
+            if result['error_count'] or result['duplicates']:
+                return render_template('import.html', result=result)
+            return redirect(url_for('index', imported=result['imported']))
     
     return render_template('import.html')
 
+def tenant_summary(tenant, path):
+    # 1団体分の集計。書き込み中の団体を待たせないよう読み取り専用で開く
+    try:
+        conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True,
+                               timeout=app.config['SQLITE_BUSY_TIMEOUT'] / 1000)
+    except sqlite3.Error as e:
+        return {'tenant': tenant, 'error': str(e)}
+    try:
+        c = conn.cursor()
+        c.execute("SELECT initial_fee, data_version, updated_at FROM settings WHERE id = 1")
+        initial_fee, data_version, updated_at = c.fetchone() or (0, 0, None)
+        c.execute("""
+            SELECT COALESCE(SUM(count), 0),
+                   COALESCE(SUM(CASE WHEN category = '収入' THEN total END), 0),
+                   COALESCE(SUM(CASE WHEN category = '支出' THEN total END), 0),
+                   MAX(month)
+            FROM monthly_rollup
+        """)
+        records, income, expense, last_month = c.fetchone()
+        closed_month = last_period_close(c)[0]
+    except sqlite3.Error as e:
+        return {'tenant': tenant, 'error': str(e)}
+    finally:
+        conn.close()
+    return {
+        'tenant': tenant,
+        'records': records,
+        'income': income,
+        'expense': expense,
+        'balance': (initial_fee or 0) + income - expense,
+        'last_month': last_month,
+        'closed_through': closed_month or None,
+        'data_version': data_version,
+        'updated_at': updated_at,
+    }
+
+def list_tenants():
+    directory = app.config['TENANTS_DIR']
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-3] for name in os.listdir(directory)
+                  if name.endswith('.db') and TENANT_PATTERN.fullmatch(name[:-3]))
+
+@app.route('/admin/tenants')
+def admin_tenants():
+    # 全団体の集計を並列に読み出す（団体ごとに別ファイルなので互いにロックを取り合わない）
+    token = app.config['ADMIN_TOKEN']
+    if not app.config['TENANT_MODE'] or not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        abort(403)
+    tenants = list_tenants()
+    with ThreadPoolExecutor(max_workers=app.config['TENANT_REPORT_WORKERS']) as executor:
+        summaries = list(executor.map(lambda t: tenant_summary(t, tenant_db_path(t)), tenants))
+    ok = [s for s in summaries if 'error' not in s]
+    return jsonify({
+        'tenants': summaries,
+        'totals': {
+            'tenants': len(summaries),
+            'errors': len(summaries) - len(ok),
+            'records': sum(s['records'] for s in ok),
+            'income': sum(s['income'] for s in ok),
+            'expense': sum(s['expense'] for s in ok),
+        },
+    })
+
 if __name__ == '__main__':
     init_db()
     app.run(debug=True)
@@ -0,0 +1,121 @@
+import gzip
+import hashlib
+import json
+import os
+
+import click
+from flask import abort, request, send_file, url_for
+from werkzeug.utils import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli が無い環境では gzip だけを作る
+    brotli = None
+
+# ビルド対象の拡張子と Content-Type
+ASSET_TYPES = {'.css': 'text/css', '.js': 'text/javascript'}
+OUTPUT_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+# ファイル名に内容のハッシュが入っているので、中身が変わればURLも変わる
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def hashed_name(name, data):
+    base, ext = os.path.splitext(name)
+    return f"{base}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+def _write(path, data):
+    # 複数のワーカーが同時にビルドしても読みかけのファイルが見えないよう、置き換えで書く
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def build(static_dir):
+    # static_dir 以下の CSS/JS をハッシュ付きの名前で dist/ に出力し、.gz（と .br）も作る
+    output_dir = os.path.join(static_dir, OUTPUT_DIR)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != output_dir)
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1] not in ASSET_TYPES:
+                continue
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            manifest[name] = hashed_name(name, data)
+            target = os.path.join(output_dir, manifest[name])
+            if os.path.exists(target):
+                continue
+            _write(target + '.gz', gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                _write(target + '.br', brotli.compress(data, quality=11))
+            _write(target, data)
+    _prune(output_dir, set(manifest.values()))
+    # 中身が同じならマニフェストは書き直さない（同時に起動した他のワーカーと同じ内容になる）
+    if load_manifest(static_dir) != manifest:
+        _write(os.path.join(output_dir, MANIFEST_NAME),
+               json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+def _prune(output_dir, keep):
+    # 今のマニフェストに無い古いハッシュのファイルを消す。書きかけの .tmp は他のワーカーのものかもしれないので残す
+    for root, _, files in os.walk(output_dir):
+        for filename in files:
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, output_dir).replace(os.sep, '/')
+            if name == MANIFEST_NAME or name.endswith('.tmp'):
+                continue
+            for suffix in ('.gz', '.br'):
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+            if name not in keep:
+                os.remove(path)
+
+def load_manifest(static_dir):
+    try:
+        with open(os.path.join(static_dir, OUTPUT_DIR, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def init_app(app):
+    # 起動時にビルドし（ASSETS_BUILD_ON_STARTUP）、テンプレート用の asset_url() と配信ルートを登録する
+    static_dir = app.static_folder
+    output_dir = os.path.join(static_dir, OUTPUT_DIR)
+    manifest = build(static_dir) if app.config.get('ASSETS_BUILD_ON_STARTUP') else load_manifest(static_dir)
+    app.extensions['assets'] = manifest
+    served = set(manifest.values())
+
+    @app.template_global()
+    def asset_url(name):
+        # ビルドされていない（マニフェストに無い）ファイルは static/ からそのまま配信する
+        hashed = app.extensions['assets'].get(name)
+        if hashed is None:
+            return url_for('static', filename=name)
+        return url_for('assets', filename=hashed)
+
+    @app.route('/assets/<path:filename>')
+    def assets(filename):
+        path = safe_join(output_dir, filename)
+        if filename not in served or path is None:
+            abort(404)
+        accepted = request.accept_encodings
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[encoding] and os.path.exists(path + suffix):
+                response = send_file(path + suffix, mimetype=ASSET_TYPES[os.path.splitext(path)[1]])
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_file(path, mimetype=ASSET_TYPES[os.path.splitext(path)[1]])
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """static/ の CSS/JS をハッシュ付きの名前で static/dist/ に出力する（.gz/.br 付き）"""
+        result = build(static_dir)
+        for name, hashed in sorted(result.items()):
+            click.echo(f'{name} -> {hashed}')
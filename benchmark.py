@@ -0,0 +1,259 @@
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import app as account_app
+
+# 合成データの分布（区分ごとのサブカテゴリと重み、金額の範囲）
+SUBCATEGORIES = {
+    '収入': [('会費', 60, 1000, 5000), ('寄付', 10, 3000, 50000), ('イベント収入', 20, 500, 20000), ('', 10, 100, 3000)],
+    '支出': [('飲食', 30, 300, 8000), ('交通', 20, 200, 5000), ('備品', 15, 500, 30000),
+             ('会場費', 10, 5000, 60000), ('印刷', 10, 100, 10000), ('合宿', 5, 10000, 150000), ('', 10, 100, 3000)],
+}
+MEMO_WORDS = ['定例会', '合宿', '新歓', '打ち上げ', '備品購入', '会場予約', 'チラシ', '交通費精算', '差し入れ', '年会費']
+# 収入:支出の件数比
+CATEGORY_WEIGHTS = [('収入', 30), ('支出', 70)]
+# 一度に挿入する行数
+INSERT_BATCH_SIZE = 10000
+
+def generate_records(n, seed=0, months=36, end=None):
+    # 直近 months か月に散らばった (date, category, subcategory, amount, memo) を決定的に生成する
+    rng = random.Random(seed)
+    end = end or date(2026, 9, 30)
+    start = end - timedelta(days=months * 30)
+    span = (end - start).days
+    categories = [c for c, _ in CATEGORY_WEIGHTS]
+    category_weights = [w for _, w in CATEGORY_WEIGHTS]
+    for _ in range(n):
+        category = rng.choices(categories, category_weights)[0]
+        options = SUBCATEGORIES[category]
+        subcategory, _, low, high = rng.choices(options, [o[1] for o in options])[0]
+        day = start + timedelta(days=rng.randrange(span + 1))
+        amount = rng.randint(low // 100, high // 100) * 100
+        memo = f"{rng.choice(MEMO_WORDS)} {rng.randrange(1000)}"
+        yield day.isoformat(), category, subcategory, amount, memo
+
+def generate_budgets(seed=0, months=36, end=None):
+    # 各月の支出サブカテゴリごとの予算と、月指定なしの全体予算
+    rng = random.Random(seed)
+    end = end or date(2026, 9, 30)
+    month = date(end.year, end.month, 1)
+    for _ in range(months):
+        for subcategory, _, low, high in SUBCATEGORIES['支出']:
+            if subcategory:
+                yield '支出', subcategory, rng.randint(low, high) * 10 // 100 * 100, month.strftime('%Y-%m'), month.year
+        month = (month - timedelta(days=1)).replace(day=1)
+    yield '支出', '', 500000, '', end.year
+
+def populate(db_path, n_records, seed=0, months=36):
+    account_app.DB_NAME = db_path
+    account_app.init_db()
+    conn = account_app.connect_db(db_path)
+    rows = generate_records(n_records, seed, months)
+    while True:
+        batch = [row for _, row in zip(range(INSERT_BATCH_SIZE), rows)]
+        if not batch:
+            break
+        conn.executemany("INSERT INTO records (date, category, subcategory, amount, memo) VALUES (?, ?, ?, ?, ?)", batch)
+    conn.executemany("INSERT INTO budgets (category, subcategory, amount, month, year) VALUES (?, ?, ?, ?, ?)",
+                     generate_budgets(seed, months))
+    account_app.bump_data_version(conn.cursor())
+    conn.commit()
+    conn.close()
+
+def import_payload(n, seed):
+    # /import に送る CSV（日付, 区分, 金額, メモ, サブカテゴリ）
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['日付', '区分', '金額', 'メモ', 'サブカテゴリ'])
+    for d, category, subcategory, amount, memo in generate_records(n, seed):
+        writer.writerow([d, category, amount, memo, subcategory])
+    return output.getvalue().encode('utf-8')
+
+def scenarios(import_rows):
+    # (名前, メソッド, URL, フォームを作る関数)。/import はデータを増やすので最後に置く
+    reads = [
+        ('index', '/'),
+        ('index_page_50', '/?page=50'),
+        ('index_sort_amount', '/?sort=amount&order=desc'),
+        ('index_sort_category_asc', '/?sort=category&order=asc&page=10'),
+        ('index_filter_category', '/?category=支出'),
+        ('index_filter_dates', '/?date_from=2025-01-01&date_to=2025-06-30'),
+        ('index_search_text', '/?search=合宿'),
+        ('index_search_amount', '/?search=1000-5000'),
+        ('api_chart_data', '/api/chart-data'),
+        ('api_monthly_trend', '/api/monthly-trend'),
+        ('api_category_pie_data', '/api/category-pie-data'),
+        ('api_search', '/api/search?q=打ち上げ'),
+        ('reports', '/reports'),
+        ('budget', '/budget'),
+        ('export', '/export'),
+        ('export_gzip', '/export?gzip=1'),
+    ]
+    for name, url in reads:
+        yield name, 'GET', url, None
+    yield 'import', 'POST', '/import', lambda i: {'file': (io.BytesIO(import_payload(import_rows, 1000 + i)), 'bench.csv')}
+
+def percentile(values, p):
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+def run(db_path, iterations, import_rows):
+    account_app.DB_NAME = db_path
+    account_app.app.config['TESTING'] = True
+    client = account_app.app.test_client()
+    account_app.ensure_schema(db_path)  # スキーマの確認は最初のリクエストの数に入れない
+    queries = []
+    tracing = threading.Event()
+
+    def trace(statement):
+        # FTS5 などの内部 SQL（"-- " 始まり）と、トリガー実行で繰り返し通知される同じ文は数えない
+        # 先行計算スレッドの作り直しは前のルートの書き込みが起こしたものなので数えない
+        if not tracing.is_set() or threading.current_thread().name == 'precompute':
+            return
+        if statement.startswith('--') or (queries and queries[-1] == statement):
+            return
+        queries.append(statement)
+
+    # リクエスト中に開かれる接続（プールの2本目や書き込みキューの接続）も数えられるよう、
+    # すべての接続に connect_db() の時点でトレースを付ける。それまでに開いた接続は閉じておく
+    connect_db = account_app.connect_db
+
+    def traced_connect_db(path=None):
+        conn = connect_db(path)
+        conn.set_trace_callback(trace)
+        return conn
+
+    account_app.connect_db = traced_connect_db
+    account_app.close_idle_connections()
+
+    def request(method, url, form):
+        if method == 'GET':
+            response = client.get(url)
+        else:
+            response = client.post(url, data=form, content_type='multipart/form-data')
+        response.get_data()  # ストリーミング応答も最後まで読む
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {url} -> {response.status_code}')
+
+    results = {}
+    for name, method, url, make_form in scenarios(import_rows):
+        # 1回目はメモリとクエリ数だけを測る（tracemalloc は遅いので時間計測とは分ける）
+        queries.clear()
+        form = make_form(iterations) if make_form else None
+        tracing.set()
+        tracemalloc.start()
+        request(method, url, form)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        tracing.clear()
+        query_count = len(queries)
+
+        latencies = []
+        for i in range(iterations):
+            form = make_form(i) if make_form else None
+            started = time.perf_counter()
+            request(method, url, form)
+            latencies.append((time.perf_counter() - started) * 1000)
+        results[name] = {
+            'url': url,
+            'method': method,
+            'iterations': iterations,
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(statistics.fmean(latencies), 3),
+            'peak_memory_kb': round(peak / 1024, 1),
+            'queries': query_count,
+        }
+    account_app.connect_db = connect_db
+    return results
+
+def compare(results, baseline, threshold):
+    # p95・ピークメモリ・クエリ数が基準より threshold を超えて悪化したルートを返す
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get('routes', {}).get(name)
+        if not before:
+            continue
+        for metric in ('p95_ms', 'peak_memory_kb', 'queries'):
+            old, new = before[metric], current[metric]
+            limit = old * (1 + threshold) if metric != 'queries' else old
+            if new > limit:
+                regressions.append({'route': name, 'metric': metric, 'baseline': old, 'current': new})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='合成データで各ルートのレイテンシ・メモリ・クエリ数を計測する')
+    parser.add_argument('--records', type=int, default=10000, help='生成するレコード数')
+    parser.add_argument('--months', type=int, default=36, help='データを散らばらせる月数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=20, help='ルートごとの計測回数')
+    parser.add_argument('--import-rows', type=int, default=1000, help='/import 1回あたりの行数')
+    parser.add_argument('--db', help='既存の生成済みDBを使う（コピーして計測する）')
+    parser.add_argument('--output', help='結果JSONの出力先（省略時は標準出力）')
+    parser.add_argument('--baseline', help='比較する過去の結果JSON')
+    parser.add_argument('--threshold', type=float, default=0.2, help='悪化とみなす割合（p95・メモリ）')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='account-bench-')
+    try:
+        db_path = os.path.join(workdir, 'bench.db')
+        started = time.perf_counter()
+        if args.db:
+            shutil.copyfile(args.db, db_path)
+            account_app.DB_NAME = db_path
+            account_app.init_db()
+        else:
+            populate(db_path, args.records, args.seed, args.months)
+        setup_seconds = time.perf_counter() - started
+
+        conn = sqlite3.connect(db_path)
+        record_count = conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        conn.close()
+
+        report = {
+            'records': record_count,
+            'iterations': args.iterations,
+            'setup_seconds': round(setup_seconds, 2),
+            'sqlite_version': sqlite3.sqlite_version,
+            'routes': run(db_path, args.iterations, args.import_rows),
+        }
+        exit_code = 0
+        if args.baseline:
+            with open(args.baseline, encoding='utf-8') as f:
+                report['regressions'] = compare(report['routes'], json.load(f), args.threshold)
+            exit_code = 1 if report['regressions'] else 0
+
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+        for regression in report.get('regressions', []):
+            print(f"悪化: {regression['route']} {regression['metric']} "
+                  f"{regression['baseline']} -> {regression['current']}", file=sys.stderr)
+        return exit_code
+    finally:
+        # プールに残った接続を閉じてから一時ディレクトリを消す
+        account_app.close_idle_connections()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
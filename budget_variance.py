@@ -0,0 +1,77 @@
+import calendar
+from collections import defaultdict
+from datetime import date
+
+def month_range(start, end):
+    # 'YYYY-MM' から 'YYYY-MM' まで（両端を含む）の月の一覧
+    year, month = map(int, start.split('-'))
+    end_year, end_month = map(int, end.split('-'))
+    months = []
+    while (year, month) <= (end_year, end_month):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def budget_periods(budget_month, budget_year, months):
+    # 年月指定の予算はその月だけ、年月なしの予算は（年があればその年の）各月に毎月適用する
+    if budget_month:
+        return [budget_month] if budget_month in months else []
+    if budget_year:
+        return [m for m in months if m.startswith(f"{int(budget_year):04d}-")]
+    return months
+
+def projected_spend(actual, month, today):
+    # 今月は経過日数から月末の見込みを出す。過去・未来の月は実績のまま
+    if month != today.strftime('%Y-%m'):
+        return actual
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    return round(actual * days_in_month / today.day)
+
+def compute_variance(budgets, actuals, months, today=None):
+    # budgets: (id, category, subcategory, amount, month, year) の行
+    # actuals: (month, category, subcategory, total) の集計行（月×区分×サブカテゴリで1回集計したもの）
+    today = today or date.today()
+    by_subcategory = {}
+    by_category = defaultdict(int)
+    for month, category, subcategory, total in actuals:
+        by_subcategory[(month, category, subcategory or '')] = total
+        by_category[(month, category)] += total
+
+    rows = []
+    for budget_id, category, subcategory, amount, budget_month, budget_year in budgets:
+        subcategory = subcategory or ''
+        amount = int(amount or 0)
+        for month in budget_periods(budget_month, budget_year, months):
+            # サブカテゴリ空欄の予算は区分全体の実績と比べる
+            if subcategory:
+                actual = by_subcategory.get((month, category, subcategory), 0)
+            else:
+                actual = by_category.get((month, category), 0)
+            projected = projected_spend(actual, month, today)
+            rows.append({
+                'budget_id': budget_id,
+                'month': month,
+                'category': category,
+                'subcategory': subcategory,
+                'budget': amount,
+                'actual': actual,
+                'remaining': amount - actual,
+                'burn_rate': round(actual / amount, 4) if amount > 0 else None,
+                'projected': projected,
+                'projected_remaining': amount - projected,
+            })
+    rows.sort(key=lambda r: (r['month'], r['category'], r['subcategory'], r['budget_id']), reverse=True)
+    return rows
+
+def summarize(rows):
+    # 期間全体の合計
+    budget = sum(r['budget'] for r in rows)
+    actual = sum(r['actual'] for r in rows)
+    projected = sum(r['projected'] for r in rows)
+    return {
+        'budget': budget,
+        'actual': actual,
+        'remaining': budget - actual,
+        'burn_rate': round(actual / budget, 4) if budget > 0 else None,
+        'projected': projected,
+    }
@@ -0,0 +1,161 @@
+import sqlite3
+import threading
+import time
+
+from flask import Response, g, has_request_context, request, before_render_template, template_rendered
+
+# リクエスト時間ヒストグラムのバケット（秒）
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 実行計画を取らない文（EXPLAIN QUERY PLAN が意味を持たないもの）
+NO_PLAN_PREFIXES = ('PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'CREATE', 'DROP', 'ALTER', 'EXPLAIN')
+
+_lock = threading.Lock()
+# エンドポイントごとの集計値
+_metrics = {}
+_slow_queries = {'count': 0}
+
+def _endpoint_metrics(endpoint):
+    metrics = _metrics.get(endpoint)
+    if metrics is None:
+        metrics = _metrics[endpoint] = {
+            'buckets': [0] * len(REQUEST_BUCKETS),
+            'count': 0,
+            'sum': 0.0,
+            'sql_statements': 0,
+            'sql_seconds': 0.0,
+            'render_seconds': 0.0,
+        }
+    return metrics
+
+def _record_statement(conn, sql, params, elapsed):
+    # リクエスト中なら SQL の件数と時間を積み、遅い文は実行計画付きでログに残す
+    if not has_request_context():
+        return
+    g.setdefault('sql_statements', 0)
+    g.sql_statements += 1
+    g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+    threshold = conn.slow_query_ms
+    if threshold is not None and elapsed * 1000 >= threshold:
+        with _lock:
+            _slow_queries['count'] += 1
+        plan = explain(conn, sql, params)
+        conn.logger.warning('slow query %.1fms [%s]\n%s\n%s', elapsed * 1000, request.endpoint, sql.strip(), plan)
+
+def explain(conn, sql, params=()):
+    if sql.lstrip().upper().startswith(NO_PLAN_PREFIXES):
+        return ''
+    try:
+        cursor = sqlite3.Cursor(conn)  # 計測対象にならない素のカーソル
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return '\n'.join(f"  {row[3]}" for row in cursor.fetchall())
+    except sqlite3.Error as e:
+        return f"  (実行計画を取得できません: {e})"
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _record_statement(self.connection, sql, params, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            _record_statement(self.connection, sql, (), time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+    # 計測用の接続。connect_db() で factory として使う
+    slow_query_ms = None
+    logger = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+def _before_render(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+def _after_render(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        g.render_seconds = g.get('render_seconds', 0.0) + time.perf_counter() - started
+
+def init_app(app):
+    # INSTRUMENTATION が有効なときだけフックと /metrics を登録する
+    if not app.config.get('INSTRUMENTATION'):
+        return
+    InstrumentedConnection.slow_query_ms = app.config.get('SLOW_QUERY_MS')
+    InstrumentedConnection.logger = app.logger
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        sql_statements = g.get('sql_statements', 0)
+        sql_seconds = g.get('sql_seconds', 0.0)
+        render_seconds = g.get('render_seconds', 0.0)
+        with _lock:
+            metrics = _endpoint_metrics(request.endpoint or 'unknown')
+            for i, bound in enumerate(REQUEST_BUCKETS):
+                if elapsed <= bound:
+                    metrics['buckets'][i] += 1
+            metrics['count'] += 1
+            metrics['sum'] += elapsed
+            metrics['sql_statements'] += sql_statements
+            metrics['sql_seconds'] += sql_seconds
+            metrics['render_seconds'] += render_seconds
+        response.headers['Server-Timing'] = (f"total;dur={elapsed * 1000:.1f}, "
+                                             f"sql;dur={sql_seconds * 1000:.1f};desc=\"{sql_statements} queries\", "
+                                             f"render;dur={render_seconds * 1000:.1f}")
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def render_metrics():
+    # Prometheus のテキスト形式で出力する
+    lines = [
+        '# HELP account_request_duration_seconds Request wall time per endpoint.',
+        '# TYPE account_request_duration_seconds histogram',
+    ]
+    with _lock:
+        snapshot = {endpoint: dict(m, buckets=list(m['buckets'])) for endpoint, m in _metrics.items()}
+        slow_queries = _slow_queries['count']
+    for endpoint, m in sorted(snapshot.items()):
+        for bound, count in zip(REQUEST_BUCKETS, m['buckets']):
+            lines.append(f'account_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+        lines.append(f'account_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {m["count"]}')
+        lines.append(f'account_request_duration_seconds_sum{{endpoint="{endpoint}"}} {m["sum"]:.6f}')
+        lines.append(f'account_request_duration_seconds_count{{endpoint="{endpoint}"}} {m["count"]}')
+    for name, key, help_text in (
+        ('account_sql_statements_total', 'sql_statements', 'SQL statements executed per endpoint.'),
+        ('account_sql_duration_seconds_total', 'sql_seconds', 'Time spent executing SQL per endpoint.'),
+        ('account_template_render_seconds_total', 'render_seconds', 'Time spent rendering templates per endpoint.'),
+    ):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for endpoint, m in sorted(snapshot.items()):
+            value = m[key]
+            lines.append(f'{name}{{endpoint="{endpoint}"}} {value:.6f}' if isinstance(value, float)
+                         else f'{name}{{endpoint="{endpoint}"}} {value}')
+    lines.append('# HELP account_slow_queries_total SQL statements slower than SLOW_QUERY_MS.')
+    lines.append('# TYPE account_slow_queries_total counter')
+    lines.append(f'account_slow_queries_total {slow_queries}')
+    return '\n'.join(lines) + '\n'
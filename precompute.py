@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class Entry:
+    # 作り終えた集計結果と、それがどのデータ版数から作られたか
+    def __init__(self, payload, data_version, updated_at, built_at):
+        self.payload = payload
+        self.data_version = data_version
+        self.updated_at = updated_at
+        self.built_at = built_at
+        self.built_monotonic = time.monotonic()
+        self.stale_since = None  # データが変わってこの結果が古くなった時刻（最初に気づいたとき）
+
+    @property
+    def age(self):
+        return time.time() - self.built_at
+
+class Precomputer:
+    # 集計結果を DB ファイル×キーごとに持ち、データが変わったら書き込みが落ち着くのを待って専用スレッドで作り直す
+    # runner(path, builder) は builder() を path のDBに対して実行し (payload, data_version, updated_at) を返す
+    # 作り直すのは前回作ってから読まれた結果だけ（それ以外は次に読まれたときに作る）。
+    # is_current(key) が偽になったキー（日付が変わったものなど）は捨てる
+    def __init__(self, runner, debounce_ms=500, max_staleness=30, max_entries=256, is_current=None):
+        self._runner = runner
+        self._is_current = is_current
+        self._debounce = debounce_ms / 1000
+        self._max_staleness = max_staleness
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._slots = OrderedDict()  # (path, key) -> [builder, Entry, 前回作ってから読まれたか]
+        self._dirty = {}  # path -> 最初に変更を知った時刻
+        self._notified = {}  # path -> 最後に変更を知った時刻
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='precompute', daemon=True)
+            self._thread.start()
+
+    def notify(self, path):
+        # 書き込みのコミット後に呼ぶ
+        now = time.monotonic()
+        with self._lock:
+            self._dirty.setdefault(path, now)
+            self._notified[path] = now
+            self._start()
+        self._wake.set()
+
+    def get(self, path, key, builder, data_version, max_staleness=None):
+        # (Entry, 古いかどうか) を返す。最新なら即返す。古くても許容範囲内なら古いまま返して作り直しを頼み、
+        # 範囲を超えていればここで作る
+        now = time.monotonic()
+        if max_staleness is None:
+            max_staleness = self._max_staleness
+        with self._lock:
+            slot = self._slots.get((path, key))
+            if slot is not None:
+                self._slots.move_to_end((path, key))
+                slot[2] = True
+                entry = slot[1]
+                if entry.data_version == data_version:
+                    return entry, False
+                # 別プロセスの書き込みなど、notify() されていない変更もここで拾う
+                # 古くなった時刻は、変更を知った時刻とこの結果を作った時刻の遅いほう。結果ごとに一度だけ決める
+                if entry.stale_since is None:
+                    entry.stale_since = max(self._dirty.setdefault(path, now), entry.built_monotonic)
+                self._dirty.setdefault(path, now)
+                self._notified.setdefault(path, now)
+                self._start()
+                self._wake.set()
+                if now - entry.stale_since <= max_staleness:
+                    return entry, True
+        entry = self._build(path, key, builder)
+        with self._lock:
+            self._slots[(path, key)] = [builder, entry, False]
+            self._slots.move_to_end((path, key))
+            self._evict_expired()
+            while len(self._slots) > self._max_entries:
+                self._slots.popitem(last=False)
+        return entry, False
+
+    def _evict_expired(self):
+        # ロックを持って呼ぶ
+        if self._is_current is None:
+            return
+        for slot_key in [k for k in self._slots if not self._is_current(k[1])]:
+            del self._slots[slot_key]
+
+    def _build(self, path, key, builder):
+        payload, data_version, updated_at = self._runner(path, builder)
+        return Entry(payload, data_version, updated_at, time.time())
+
+    def _wait_for_quiet(self):
+        # 最後の変更から debounce の間、新しい変更が来なくなるまで待つ（ただし最初の変更から max_staleness の半分まで）
+        while True:
+            with self._lock:
+                if not self._dirty:
+                    return
+                quiet_at = max(self._notified.values()) + self._debounce
+                deadline = min(self._dirty.values()) + self._max_staleness / 2
+            remaining = min(quiet_at, deadline) - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self._wait_for_quiet()
+            with self._lock:
+                paths = list(self._dirty)
+            for path in paths:
+                started = time.monotonic()
+                with self._lock:
+                    self._evict_expired()
+                    slots = []
+                    for (p, key), slot in self._slots.items():
+                        if p == path and slot[2]:
+                            slots.append((key, slot[0]))
+                            slot[2] = False
+                failed = False
+                for key, builder in slots:
+                    try:
+                        entry = self._build(path, key, builder)
+                    except Exception:
+                        logger.exception('precompute failed: %s %r', path, key)
+                        failed = True
+                        with self._lock:
+                            slot = self._slots.get((path, key))
+                            if slot is not None:
+                                slot[2] = True
+                        continue
+                    with self._lock:
+                        slot = self._slots.get((path, key))
+                        if slot is not None and entry.data_version >= slot[1].data_version:
+                            slot[1] = entry
+                with self._lock:
+                    # 作り直している間に新しい変更が来ていれば、もう一度回す
+                    # 失敗した集計があれば古いままなので、次のリクエストか変更で作り直せるよう変更ありのままにする
+                    if self._notified.get(path, 0) > started:
+                        self._dirty[path] = started
+                        self._wake.set()
+                    elif not failed:
+                        self._dirty.pop(path, None)
+                        self._notified.pop(path, None)
@@ -0,0 +1,78 @@
+// サブカテゴリの定義
+const subcategories = {
+    '収入': ['会費', '寄付', '補助金', 'その他'],
+    '支出': ['会議費', '備品', '交通費', '飲食費', 'イベント', 'その他']
+};
+
+// サブカテゴリの更新（単体登録）
+function updateSubcategories(type) {
+    const categorySelect = document.getElementById(`category-${type}`);
+    const subcategorySelect = document.getElementById(`subcategory-${type}`);
+    const category = categorySelect.value;
+    
+    subcategorySelect.innerHTML = '<option value="">選択してください</option>';
+    if (subcategories[category]) {
+        subcategories[category].forEach(sub => {
+            const option = document.createElement('option');
+            option.value = sub;
+            option.textContent = sub;
+            subcategorySelect.appendChild(option);
+        });
+    }
+}
+
+// サブカテゴリの更新（複数登録）
+function updateSubcategoriesMulti(selectElement) {
+    const category = selectElement.value;
+    const subcategorySelect = selectElement.closest('.record-item').querySelector('.subcategory-select');
+    
+    subcategorySelect.innerHTML = '<option value="">選択</option>';
+    if (subcategories[category]) {
+        subcategories[category].forEach(sub => {
+            const option = document.createElement('option');
+            option.value = sub;
+            option.textContent = sub;
+            subcategorySelect.appendChild(option);
+        });
+    }
+}
+
+// 行追加機能
+function addRow() {
+    const container = document.getElementById('form-container');
+    const newRow = container.firstElementChild.cloneNode(true);
+    newRow.querySelectorAll('input').forEach(i => i.value = '');
+    newRow.querySelectorAll('.category-select').forEach(s => {
+        s.selectedIndex = 0;
+        updateSubcategoriesMulti(s);
+    });
+    newRow.querySelector('.remove-btn').style.display = 'block';
+    container.appendChild(newRow);
+}
+
+// 初期化
+updateSubcategories('single');
+
+// 行削除機能
+function removeRow(btn) {
+    const container = document.getElementById('form-container');
+    if (container.children.length > 1) {
+        btn.closest('.record-item').remove();
+    }
+}
+
+// 最初の行の削除ボタンを非表示
+document.querySelector('.remove-btn').style.display = 'none';
+
+// 日付自動変換機能（6桁入力で自動変換）
+document.querySelectorAll('input[type="date"]').forEach(el => {
+    el.addEventListener('input', e => {
+        const val = e.target.value;
+        // 6桁（例: 202511）を自動で 2025-11-01 に変換
+        if (/^\d{6}$/.test(val)) {
+            const y = val.slice(0,4);
+            const m = val.slice(4,6);
+            e.target.value = `${y}-${m}-01`;
+        }
+    });
+});
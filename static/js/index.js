@@ -0,0 +1,160 @@
+// アプリのルート（団体ごとのURLプレフィックスを含む）
+const scriptRoot = document.body.dataset.scriptRoot;
+
+// インポート完了の通知は5秒で消す
+const notification = document.getElementById('notification');
+if (notification) {
+    setTimeout(() => notification.classList.remove('show'), 5000);
+}
+
+// テーマ切り替え
+function toggleTheme() {
+    const html = document.documentElement;
+    const currentTheme = html.getAttribute('data-theme');
+    const newTheme = currentTheme === 'dark' ? 'light' : 'dark';
+    html.setAttribute('data-theme', newTheme);
+    localStorage.setItem('theme', newTheme);
+    updateThemeIcon(newTheme);
+}
+
+function updateThemeIcon(theme) {
+    const icon = document.getElementById('theme-icon');
+    icon.className = theme === 'dark' ? 'bi bi-sun-fill' : 'bi bi-moon-fill';
+}
+
+// テーマの読み込み
+const savedTheme = localStorage.getItem('theme') || 'light';
+document.documentElement.setAttribute('data-theme', savedTheme);
+updateThemeIcon(savedTheme);
+
+// 並び替え機能
+function sortBy(field) {
+    const urlParams = new URLSearchParams(window.location.search);
+    const currentSort = urlParams.get('sort');
+    const currentOrder = urlParams.get('order');
+    
+    let newOrder = 'desc';
+    if (currentSort === field && currentOrder === 'desc') {
+        newOrder = 'asc';
+    }
+    
+    urlParams.set('sort', field);
+    urlParams.set('order', newOrder);
+    // 並び替えを変えたらページ位置はリセット
+    urlParams.delete('page');
+    urlParams.delete('cursor');
+    window.location.search = urlParams.toString();
+}
+
+// グラフの描画
+fetch(scriptRoot + '/api/chart-data')
+    .then(response => response.json())
+    .then(data => {
+        const ctx = document.getElementById('chart').getContext('2d');
+        const isDark = document.documentElement.getAttribute('data-theme') === 'dark';
+        
+        new Chart(ctx, {
+            type: 'line',
+            data: {
+                labels: data.months,
+                datasets: [{
+                    label: '収入',
+                    data: data.income,
+                    borderColor: '#10b981',
+                    backgroundColor: 'rgba(16, 185, 129, 0.1)',
+                    tension: 0.4,
+                    fill: true,
+                    borderWidth: 3
+                }, {
+                    label: '支出',
+                    data: data.expense,
+                    borderColor: '#ef4444',
+                    backgroundColor: 'rgba(239, 68, 68, 0.1)',
+                    tension: 0.4,
+                    fill: true,
+                    borderWidth: 3
+                }]
+            },
+            options: {
+                responsive: true,
+                maintainAspectRatio: true,
+                plugins: {
+                    legend: {
+                        position: 'top',
+                        labels: {
+                            color: isDark ? '#f1f5f9' : '#1f2937',
+                            font: { size: 14, weight: '600' }
+                        }
+                    }
+                },
+                scales: {
+                    x: {
+                        ticks: { color: isDark ? '#cbd5e1' : '#6b7280' },
+                        grid: { color: isDark ? 'rgba(255,255,255,0.1)' : 'rgba(0,0,0,0.1)' }
+                    },
+                    y: {
+                        beginAtZero: true,
+                        ticks: {
+                            color: isDark ? '#cbd5e1' : '#6b7280',
+                            callback: function(value) {
+                                return value.toLocaleString() + ' 円';
+                            }
+                        },
+                        grid: { color: isDark ? 'rgba(255,255,255,0.1)' : 'rgba(0,0,0,0.1)' }
+                    }
+                }
+            }
+        });
+    });
+
+// 円グラフの描画
+fetch(scriptRoot + '/api/category-pie-data')
+    .then(response => response.json())
+    .then(data => {
+        if (data.labels.length > 0) {
+            const ctx = document.getElementById('pieChart').getContext('2d');
+            const isDark = document.documentElement.getAttribute('data-theme') === 'dark';
+            
+            new Chart(ctx, {
+                type: 'doughnut',
+                data: {
+                    labels: data.labels,
+                    datasets: [{
+                        data: data.values,
+                        backgroundColor: [
+                            '#6366f1', '#8b5cf6', '#ec4899', '#f59e0b',
+                            '#10b981', '#3b82f6', '#ef4444', '#14b8a6',
+                            '#f97316', '#a855f7'
+                        ],
+                        borderWidth: 3,
+                        borderColor: isDark ? '#1e293b' : '#ffffff'
+                    }]
+                },
+                options: {
+                    responsive: true,
+                    maintainAspectRatio: true,
+                    plugins: {
+                        legend: {
+                            position: 'bottom',
+                            labels: {
+                                color: isDark ? '#f1f5f9' : '#1f2937',
+                                font: { size: 11 },
+                                padding: 10
+                            }
+                        },
+                        tooltip: {
+                            callbacks: {
+                                label: function(context) {
+                                    const total = context.dataset.data.reduce((a, b) => a + b, 0);
+                                    const percentage = ((context.parsed / total) * 100).toFixed(1);
+                                    return context.label + ': ' + context.parsed.toLocaleString() + ' 円 (' + percentage + '%)';
+                                }
+                            }
+                        }
+                    }
+                }
+            });
+        } else {
+            document.getElementById('pieChart').parentElement.innerHTML = '<p class="text-center text-muted">データがありません</p>';
+        }
+    });
@@ -0,0 +1,105 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+class WriteQueue:
+    # 書き込みを専用スレッド1本に集め、短い時間窓に溜まった分を1トランザクションでコミットする
+    # idle_timeout 秒書き込みが無ければスレッドと接続を閉じ、次の書き込みで開き直す
+    def __init__(self, connect, before_commit=None, window_ms=5, max_batch=100, idle_timeout=60):
+        self._connect = connect
+        self._before_commit = before_commit
+        self._window = window_ms / 1000
+        self._max_batch = max_batch
+        self._idle_timeout = idle_timeout
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, fn, timeout=30):
+        # fn(cursor) をライタースレッドで実行し、コミットされるまで待って戻り値を返す
+        # timeout 秒待っても始まらなければ取り消して TimeoutError（失敗を返した書き込みが後からコミットされないように）。
+        # 始まっていればコミットされるかどうかが決まるまで待つ
+        future = Future()
+        with self._lock:
+            self._jobs.put((fn, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+                self._thread.start()
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise
+            return future.result()
+
+    def _next_batch(self):
+        # 書き込みが来ないまま idle_timeout が過ぎたら None（スレッドを終える）
+        try:
+            first = self._jobs.get(timeout=self._idle_timeout)
+        except queue.Empty:
+            with self._lock:
+                if self._jobs.empty():
+                    self._thread = None
+                    return None
+            first = self._jobs.get()
+        batch = [first]
+        deadline = time.monotonic() + self._window
+        while len(batch) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._jobs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = self._connect()
+        conn.isolation_level = None  # トランザクションはここで明示的に管理する
+        try:
+            self._loop(conn)
+        finally:
+            conn.close()
+
+    def _loop(self, conn):
+        c = conn.cursor()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            results = []  # 実行した書き込みの (future, 戻り値, 例外)
+            pending = list(batch)
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                while pending:
+                    fn, future = pending.pop(0)
+                    # 待ちきれずに取り消された書き込みは実行しない
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    # 1件の失敗でまとめた他の書き込みを巻き戻さないよう、セーブポイントで区切る
+                    c.execute("SAVEPOINT write_job")
+                    try:
+                        results.append((future, fn(c), None))
+                        c.execute("RELEASE write_job")
+                    except Exception as e:
+                        c.execute("ROLLBACK TO write_job")
+                        c.execute("RELEASE write_job")
+                        results.append((future, None, e))
+                if self._before_commit and any(error is None for _, _, error in results):
+                    self._before_commit(c)
+                c.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                failed = [future for future, _, _ in results]
+                failed += [future for _, future in pending if future.set_running_or_notify_cancel()]
+                for future in failed:
+                    future.set_exception(e)
+                continue
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)